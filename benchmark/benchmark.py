@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+"""
+File: benchmark.py
+
+Description:	Measure the throughput of gcexport.py against mock_server.py, without a
+				Garmin Connect account. Each run starts a fresh mock server, exports all of
+				its activities into an empty temporary directory and reports activities and
+				bytes per second (without gcexport.py's request rate limit unless --rate is
+				given), the peak RSS of the exporter and the time spent in each phase: from
+				the server's point of view (from the first to the last request of the phase,
+				along with the number of requests in it), and as measured by the exporter
+				itself (--metrics-file; added up over the workers).
+
+				Arguments after '--' are passed on to gcexport.py, e.g.:
+
+					python benchmark/benchmark.py -a 500 --latency 50 -r 3 -- -f original -u -w 8
+"""
+
+from glob import glob
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+gcexport = os.path.join(benchmark_directory, os.pardir, 'gcexport.py')
+mock_server = os.path.join(benchmark_directory, 'mock_server.py')
+
+parser = argparse.ArgumentParser(description='Benchmark gcexport.py against a mock Garmin Connect server.',
+	usage='%(prog)s [options] [-- gcexport.py options]')
+parser.add_argument('-a', '--activities', type=int, default=100, help="number of activities (default: 100)")
+parser.add_argument('-t', '--track-points', type=int, default=1000,
+	help="number of track points in each data file (default: 1000)")
+parser.add_argument('--latency', type=float, default=0, help="milliseconds the server waits before each response (default: 0)")
+parser.add_argument('--jitter', type=float, default=0,
+	help="up to this many more milliseconds the server waits, at random (default: 0)")
+parser.add_argument('--error-rate', type=float, default=0,
+	help="share of the detail, device and download requests that fail (default: 0)")
+parser.add_argument('--rate', type=float, default=0,
+	help="--rate of gcexport.py, in requests per second (default: 0, no limit, so that the exporter is measured " +
+	"rather than its throttle)")
+parser.add_argument('-r', '--runs', type=int, default=1, help="number of runs (default: 1)")
+parser.add_argument('--json', help="also write the results of all runs to this file")
+parser.add_argument('-v', '--verbose', action='store_true', help="show the output of gcexport.py")
+
+# Which phase each kind of request counted by the mock server belongs to.
+phases = [
+	('login', ['login']),
+	('listing', ['list']),
+	('details', ['details']),
+	('devices', ['device']),
+	('downloads', ['gpx download', 'tcx download', 'original download'])]
+
+def free_port():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+def start_server(options, port):
+	server = subprocess.Popen([sys.executable, mock_server, '--port', str(port),
+		'--activities', str(options.activities), '--track-points', str(options.track_points),
+		'--latency', str(options.latency), '--jitter', str(options.jitter), '--error-rate', str(options.error_rate)],
+		stdout=open(os.devnull, 'w'))
+	for attempt in range(100):
+		try:
+			server_stats(port)
+			return server
+		except (urllib2.URLError, socket.error):
+			time.sleep(0.1)
+	server.kill()
+	raise Exception('The mock server did not start.')
+
+def server_stats(port):
+	return json.load(urllib2.urlopen('http://127.0.0.1:' + str(port) + '/__stats'))
+
+# The requests, bytes and wall time of each phase, from the first to the last request in it.
+def phase_stats(stats):
+	result = []
+	for phase, kinds in phases:
+		entries = [entry for kind, entry in stats.iteritems() if kind.split(' (')[0] in kinds]
+		if not entries:
+			continue
+		result.append({
+			'phase': phase,
+			'requests': sum(entry['requests'] for entry in entries),
+			'bytes': sum(entry['bytes'] for entry in entries),
+			'seconds': max(entry['last'] for entry in entries) - min(entry['first'] for entry in entries)})
+	return result
+
+def data_bytes(directory):
+	return sum(os.path.getsize(filename) for filename in glob(directory + '/*-Semana*/*') if os.path.isfile(filename))
+
+def exported_activities(directory):
+	try:
+		with open(directory + '/activities.csv') as csv_file:
+			return sum(1 for line in csv_file) - 1
+	except IOError:
+		return 0
+
+def run(options, exporter_args):
+	port = free_port()
+	server = start_server(options, port)
+	directory = tempfile.mkdtemp(prefix='gcexport-benchmark-')
+	try:
+		command = [sys.executable, gcexport, '--server', 'http://127.0.0.1:' + str(port),
+			'--username', 'benchmark', '--password', 'benchmark', '--count', 'all',
+			'--directory', directory + '/', '--metrics-file', directory + '/metrics.json', '--rate', str(options.rate)] + exporter_args
+		output = None if options.verbose else open(os.devnull, 'w')
+		start = time.time()
+		exporter = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, cwd=directory)
+		pid, status, usage = os.wait4(exporter.pid, 0)
+		seconds = time.time() - start
+		if status != 0:
+			raise Exception('gcexport.py failed (status ' + str(status) + '); run with --verbose to see why.')
+		activities = exported_activities(directory)
+		size = data_bytes(directory)
+		with open(directory + '/metrics.json') as metrics_file:
+			metrics = json.load(metrics_file)
+		return {
+			'rate': options.rate,
+			'seconds': seconds,
+			'activities': activities,
+			'activities_per_second': activities / seconds,
+			'bytes': size,
+			'bytes_per_second': size / seconds,
+			'peak_rss_kb': usage.ru_maxrss,  # Kilobytes on Linux.
+			'phases': phase_stats(server_stats(port)),
+			'exporter_phases': metrics['phases'],
+			'exporter_requests': metrics['requests']}
+	finally:
+		server.kill()
+		server.wait()
+		shutil.rmtree(directory)
+
+def report(number, result):
+	print 'Run ' + str(number) + ': ' + str(result['activities']) + ' activities in ' + \
+		'{0:.2f}'.format(result['seconds']) + ' s: ' + '{0:.1f}'.format(result['activities_per_second']) + \
+		' activities/s, ' + '{0:.1f}'.format(result['bytes_per_second'] / 1e6) + ' MB/s, peak RSS ' + \
+		str(result['peak_rss_kb'] / 1024) + ' MB (--rate ' + ('{0:g}'.format(result['rate']) if result['rate'] else '0: no limit') + ')'
+	print '\tServer:'
+	for phase in result['phases']:
+		print '\t\t{0:<10} {1:>6} requests {2:>10.1f} kB {3:>8.2f} s'.format(
+			phase['phase'], phase['requests'], phase['bytes'] / 1e3, phase['seconds'])
+	print '\tExporter:'
+	for phase, stats in sorted(result['exporter_phases'].iteritems(), key=lambda item: -item[1]['seconds']):
+		print '\t\t{0:<10} {1:>6} calls {2:>8.2f} s'.format(phase, stats['calls'], stats['seconds'])
+	for kind, stats in sorted(result['exporter_requests'].iteritems()):
+		print '\t\t{0:<10} {1:>6} requests {2:>8.1f} ms average'.format(kind, stats['count'], 1e3 * stats['seconds'] / stats['count'])
+
+if __name__ == '__main__':
+	if '--' in sys.argv:
+		separator = sys.argv.index('--')
+		options, exporter_args = parser.parse_args(sys.argv[1:separator]), sys.argv[separator + 1:]
+	else:
+		options, exporter_args = parser.parse_args(), []
+
+	results = []
+	for number in range(1, options.runs + 1):
+		result = run(options, exporter_args)
+		report(number, result)
+		results.append(result)
+
+	if options.runs > 1:
+		rates = sorted(result['activities_per_second'] for result in results)
+		print 'Median: ' + '{0:.1f}'.format(rates[len(rates) // 2]) + ' activities/s'
+
+	if options.json:
+		with open(options.json, 'w') as json_file:
+			json.dump({'arguments': exporter_args, 'options': vars(options), 'runs': results}, json_file, indent=2)
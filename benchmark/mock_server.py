@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+"""
+File: mock_server.py
+
+Description:	A local stand-in for Garmin Connect, to run gcexport.py against without an
+				account (gcexport.py --server http://127.0.0.1:8765). It serves the SSO login
+				flow, the activity list, activity details, device info and the GPX, TCX and
+				original (ZIP with a FIT file) downloads for a number of synthetic activities.
+
+				Like Garmin Connect, it needs the session cookie set after the login, rejects
+				listing pages bigger than --max-page-size and answers with an ETag for
+				activity details. The synthetic activities include the odd cases gcexport.py
+				has to deal with: every 7th one has no GPS data (204 for GPX and TCX), every
+				5th one was a GPX upload (500 for TCX) and every 6th one was entered manually
+				(404 for the original file). Every 4th one is a ride instead of a run, and the
+				list honours the startDate, endDate and activityType parameters of the search
+				unless --ignore-filters is given. With --upload-every, new activities keep
+				appearing at the head of the list, and with --session-lifetime, the session
+				expires, to try 'gcexport.py --watch'.
+
+				Responses can be delayed (--latency, --jitter) and a share of the detail,
+				device and download requests fail (--error-rate) with a 429 and a Retry-After
+				header, a 503 or a dropped connection, and a share of the downloads
+				(--truncate-rate) break off halfway through the body. GET /__stats returns the number of
+				requests, the bytes sent and the time of the first and last request of each
+				kind of request as JSON.
+"""
+
+from StringIO import StringIO
+from urlparse import urlparse, parse_qs
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import argparse
+import gzip
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zipfile
+
+parser = argparse.ArgumentParser(description='Serve synthetic Garmin Connect data.')
+parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+parser.add_argument('-p', '--port', type=int, default=8765, help="port to listen on (default: 8765)")
+parser.add_argument('-a', '--activities', type=int, default=100, help="number of activities (default: 100)")
+parser.add_argument('-t', '--track-points', type=int, default=1000,
+	help="number of track points in each data file (default: 1000)")
+parser.add_argument('--max-page-size', type=int, default=100,
+	help="largest accepted page of the activity list (default: 100)")
+parser.add_argument('--latency', type=float, default=0, help="milliseconds to wait before each response (default: 0)")
+parser.add_argument('--jitter', type=float, default=0,
+	help="up to this many more milliseconds to wait, at random (default: 0)")
+parser.add_argument('--error-rate', type=float, default=0,
+	help="share of the detail, device and download requests that fail (default: 0)")
+parser.add_argument('--ignore-filters', action='store_true',
+	help="list all activities, ignoring the startDate, endDate and activityType parameters of the search")
+parser.add_argument('--truncate-rate', type=float, default=0,
+	help="share of the downloads whose body breaks off halfway (default: 0)")
+parser.add_argument('--upload-every', type=float, default=0,
+	help="add a new activity at the head of the list every this many seconds, to try --watch (default: never)")
+parser.add_argument('--session-lifetime', type=float, default=0,
+	help="seconds after the login that the session cookie is rejected (default: never)")
+parser.add_argument('--seed', type=int, default=1, help="seed of the random latencies and errors (default: 1)")
+
+# Mon, 17 Jul 2017 10:00:00 GMT; the activities go back in time from there, one every 3 days.
+# Every 4th one is a road bike ride, the others are runs.
+first_timestamp = 1500285600000
+activity_spacing = 3 * 24 * 3600 * 1000
+first_activity_id = 1000000000
+
+# The session cookie holds the time of the login, for --session-lifetime.
+session_cookie = re.compile(r'SESSIONID=mock-session-(\d+)')
+
+def activity(i):
+	begin = first_timestamp - i * activity_spacing
+	if i % 4 == 3:
+		name, activity_type = 'Ride ', {'typeId': 10, 'parentTypeId': 2, 'typeKey': 'road_biking'}
+	else:
+		name, activity_type = 'Run ', {'typeId': 1, 'parentTypeId': 17, 'typeKey': 'running'}
+	return {
+		'activityId': first_activity_id + i,
+		'activityName': name + str(i),
+		'description': None,
+		'startTimeLocal': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(begin / 1000 + 7200)),
+		'startTimeGMT': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(begin / 1000)),
+		'activityType': activity_type,
+		'eventType': {'typeKey': 'uncategorized'},
+		'distance': 10000.0 + i,
+		'duration': 3600.0 + i,
+		'averageSpeed': 2.78,
+		'maxHR': 180.0,
+		'averageHR': 150.0,
+		'beginTimestamp': begin,
+		'elevationCorrected': i % 2 == 0,
+		'startLatitude': 40.4,
+		'startLongitude': -3.7}
+
+# Whether an activity matches the startDate, endDate (both inclusive) and activityType (a type
+# key, or the name of a parent type) parameters of a search.
+def searched(a, query):
+	day = a['startTimeLocal'][:10]
+	if 'startDate' in query and day < query['startDate'][0]:
+		return False
+	if 'endDate' in query and day > query['endDate'][0]:
+		return False
+	if 'activityType' in query:
+		parent = {2: 'cycling'}.get(a['activityType']['parentTypeId'])
+		if query['activityType'][0] not in (a['activityType']['typeKey'], parent):
+			return False
+	return True
+
+def activity_details(i):
+	return {
+		'activityId': first_activity_id + i,
+		'summaryDTO': {'elapsedDuration': 3700.0 + i, 'movingDuration': 3500.0 + i, 'averageMovingSpeed': 2.85,
+			'maxSpeed': 4.1, 'elevationGain': 10.5, 'elevationLoss': 9.5, 'minElevation': 600.0,
+			'maxElevation': 650.0, 'calories': 700.0, 'averageRunCadence': 82.0, 'maxRunCadence': 95.0},
+		'metadataDTO': {'deviceApplicationInstallationId': 100 + i % 3}}
+
+def point(k):
+	return 40.4 + k * 1e-5, -3.7 + k * 1e-5, 600.0 + k % 50, 120 + k % 50
+
+def point_time(k):
+	return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(first_timestamp / 1000 + k))
+
+def make_gpx(points):
+	s = StringIO()
+	s.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx creator="mock_server" version="1.1" '
+		'xmlns="http://www.topografix.com/GPX/1/1" '
+		'xmlns:ns3="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n<trk><name>Run</name><trkseg>\n')
+	for k in range(points):
+		lat, lon, elevation, hr = point(k)
+		s.write('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%s</time><extensions>'
+			'<ns3:TrackPointExtension><ns3:hr>%d</ns3:hr><ns3:cad>82</ns3:cad></ns3:TrackPointExtension>'
+			'</extensions></trkpt>\n' % (lat, lon, elevation, point_time(k), hr))
+	s.write('</trkseg></trk>\n</gpx>\n')
+	return s.getvalue()
+
+def make_tcx(points):
+	s = StringIO()
+	s.write('<?xml version="1.0" encoding="UTF-8"?>\n<TrainingCenterDatabase '
+		'xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">\n<Activities>'
+		'<Activity Sport="Running"><Id>%s</Id><Lap StartTime="%s"><Track>\n' % (point_time(0), point_time(0)))
+	for k in range(points):
+		lat, lon, elevation, hr = point(k)
+		s.write('<Trackpoint><Time>%s</Time><Position><LatitudeDegrees>%.7f</LatitudeDegrees>'
+			'<LongitudeDegrees>%.7f</LongitudeDegrees></Position><AltitudeMeters>%.1f</AltitudeMeters>'
+			'<HeartRateBpm><Value>%d</Value></HeartRateBpm><Cadence>82</Cadence></Trackpoint>\n'
+			% (point_time(k), lat, lon, elevation, hr))
+	s.write('</Track></Lap></Activity></Activities>\n</TrainingCenterDatabase>\n')
+	return s.getvalue()
+
+# A FIT file with a definition message for record messages (timestamp, position, heart rate
+# and enhanced altitude) and one data message per track point.
+def make_fit(points):
+	fields = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (3, 1, 0x02), (78, 4, 0x86)]
+	records = StringIO()
+	records.write(struct.pack('<BBBHB', 0x40, 0, 0, 20, len(fields)))
+	for field in fields:
+		records.write(struct.pack('<BBB', *field))
+	semicircles = 2 ** 31 / 180.0
+	fit_epoch = 631065600
+	for k in range(points):
+		lat, lon, elevation, hr = point(k)
+		records.write(struct.pack('<BIiiBI', 0, first_timestamp / 1000 - fit_epoch + k,
+			int(lat * semicircles), int(lon * semicircles), hr, int((elevation + 500) * 5)))
+	data = records.getvalue()
+	header = struct.pack('<BBHI4sH', 14, 0x10, 2093, len(data), '.FIT', 0)
+	return header + data + '\x00\x00'
+
+class MockGarminConnect(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, options):
+		HTTPServer.__init__(self, address, Handler)
+		self.options = options
+		self.random = random.Random(options.seed)
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.stats = dict()
+		self.files = {
+			'gpx': make_gpx(options.track_points),
+			'tcx': make_tcx(options.track_points),
+			'fit': make_fit(options.track_points)}
+
+	def count(self, kind, size):
+		with self.lock:
+			now = time.time()
+			stats = self.stats.setdefault(kind, {'requests': 0, 'bytes': 0, 'first': now, 'last': now})
+			stats['requests'] += 1
+			stats['bytes'] += size
+			stats['last'] = now
+
+	# The number of activities uploaded since the server started (--upload-every). They come
+	# before the others in the list, as activities -1, -2...
+	def uploaded(self):
+		if not self.options.upload_every:
+			return 0
+		return int((time.time() - self.started) / self.options.upload_every)
+
+	def draw(self):
+		with self.lock:
+			return self.random.random(), self.random.random()
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# Headers and body are separate writes: without Nagle's algorithm the body doesn't wait for
+	# the client's delayed ACK of the headers (40 ms a response on Linux).
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def respond(self, kind, code, body='', content_type='application/json', headers={}):
+		if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+			compressed = StringIO()
+			gzip_file = gzip.GzipFile(fileobj=compressed, mode='wb')
+			gzip_file.write(body)
+			gzip_file.close()
+			body = compressed.getvalue()
+			headers = dict(headers, **{'Content-Encoding': 'gzip'})
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for key, value in headers.iteritems():
+			self.send_header(key, value)
+		self.end_headers()
+		if kind.endswith('download') and body and self.server.draw()[0] < self.server.options.truncate_rate:
+			self.wfile.write(body[:len(body) / 2])
+			self.server.count(kind + ' (truncated)', len(body) / 2)
+			self.close_connection = 1
+			return
+		self.wfile.write(body)
+		self.server.count(kind, len(body))
+
+	# Wait for the configured latency and, for the requests that may fail, maybe fail.
+	# Returns True if the request has been dealt with.
+	def inject(self, kind, may_fail):
+		options = self.server.options
+		delay, failure = self.server.draw()
+		if options.latency or options.jitter:
+			time.sleep((options.latency + delay * options.jitter) / 1000.0)
+		if not may_fail or failure >= options.error_rate:
+			return False
+		failure /= options.error_rate
+		if failure < 1 / 3.0:
+			self.respond(kind + ' (429)', 429, headers={'Retry-After': '1'})
+		elif failure < 2 / 3.0:
+			self.respond(kind + ' (503)', 503)
+		else:
+			self.server.count(kind + ' (dropped)', 0)
+			self.close_connection = 1
+		return True
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		if self.inject('login', False):
+			return
+		self.respond('login', 200, 'var response_url = "/modern/activities?ticket=ST-0000000-mock-cas";', 'text/html')
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		query = parse_qs(url.query)
+		path = url.path
+		options = self.server.options
+
+		if path == '/__stats':
+			return self.respond('stats', 200, json.dumps(self.server.stats))
+		if path.startswith('/sso/'):
+			if not self.inject('login', False):
+				self.respond('login', 200, '<html><body>Sign in</body></html>', 'text/html')
+			return
+		if path == '/modern/activities':
+			if not self.inject('login', False):
+				self.respond('login', 200, '<html></html>', 'text/html',
+					{'Set-Cookie': 'SESSIONID=mock-session-' + str(int(time.time())) + '; Path=/'})
+			return
+		session = session_cookie.search(self.headers.get('Cookie', ''))
+		if not session or options.session_lifetime and time.time() - int(session.group(1)) > options.session_lifetime:
+			return self.respond('forbidden', 403)
+
+		if path == '/modern/proxy/activitylist-service/activities/search/activities':
+			if self.inject('list', False):
+				return
+			start = int(query.get('start', ['0'])[0])
+			limit = int(query.get('limit', ['20'])[0])
+			if limit > options.max_page_size:
+				return self.respond('list (400)', 400)
+			listed = [activity(i) for i in range(-self.server.uploaded(), options.activities)]
+			if not options.ignore_filters:
+				listed = [a for a in listed if searched(a, query)]
+			return self.respond('list', 200, json.dumps(listed[start:start + limit]))
+
+		match = re.match(r'^/modern/proxy/activity-service/activity/(\d+)$', path)
+		if match:
+			i = int(match.group(1)) - first_activity_id
+			if self.inject('details', True):
+				return
+			if not -self.server.uploaded() <= i < options.activities:
+				return self.respond('details', 404)
+			etag = '"details-' + str(i) + '"'
+			if self.headers.get('If-None-Match') == etag:
+				return self.respond('details (304)', 304, headers={'ETag': etag})
+			return self.respond('details', 200, json.dumps(activity_details(i)), headers={'ETag': etag})
+
+		match = re.match(r'^/modern/proxy/device-service/deviceservice/app-info/(\d+)$', path)
+		if match:
+			if self.inject('device', True):
+				return
+			return self.respond('device', 200, json.dumps({'productDisplayName': 'Forerunner ' + match.group(1),
+				'versionString': '2.50'}))
+
+		match = re.match(r'^/modern/proxy/download-service/export/(gpx|tcx)/activity/(\d+)$', path)
+		if match:
+			format, i = match.group(1), int(match.group(2)) - first_activity_id
+			kind = format + ' download'
+			if self.inject(kind, True):
+				return
+			if format == 'tcx' and i % 5 == 4:
+				return self.respond(kind + ' (500)', 500)
+			if i % 7 == 6:
+				return self.respond(kind + ' (204)', 204)
+			return self.respond(kind, 200, self.server.files[format], 'application/xml')
+
+		match = re.match(r'^/proxy/download-service/files/activity/(\d+)$', path)
+		if match:
+			i = int(match.group(1)) - first_activity_id
+			if self.inject('original download', True):
+				return
+			if i % 6 == 5:
+				return self.respond('original download (404)', 404)
+			archive = StringIO()
+			zip_file = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+			zip_file.writestr(match.group(1) + '.fit', self.server.files['fit'])
+			zip_file.close()
+			return self.respond('original download', 200, archive.getvalue(), 'application/x-zip-compressed')
+
+		self.respond('not found', 404)
+
+if __name__ == '__main__':
+	options = parser.parse_args()
+	server = MockGarminConnect((options.host, options.port), options)
+	print 'Serving ' + str(options.activities) + ' activities on http://' + options.host + ':' + str(server.server_address[1])
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -17,25 +17,79 @@ from getpass import getpass
 from sys import argv
 from os.path import isdir
 from os.path import isfile
+from os.path import getmtime
 from os import mkdir
 from os import remove
 from os import stat
-from xml.dom.minidom import parseString
 from subprocess import call
-
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlparse
+from StringIO import StringIO
+from contextlib import contextmanager
+from collections import deque
+
+import errno
 import glob
+import multiprocessing
+import os
 import shutil
+import sqlite3
+import threading
+import time
+import _strptime  # Imported up front: the lazy import in datetime.strptime isn't thread-safe.
 
 import urllib, urllib2, cookielib, json, re
+import httplib, socket, zlib
 from fileinput import filename
 
+import ConfigParser
 import argparse
+import base64
+import calendar
+import copy
+import csv
+import email.utils
+import random
+import sys
+import tempfile
 import zipfile
 
+import gctracks
+
+try:
+	import pyarrow
+	import pyarrow.ipc
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
 script_version = '1.0.0'
 current_date = datetime.now().strftime('%Y-%m-%d')
 activities_directory = './' + current_date + '_garmin_connect_export'
 
+# A YYYY-MM-DD date on the command line.
+def parse_date(text):
+	try:
+		return datetime.strptime(text, '%Y-%m-%d').date()
+	except ValueError:
+		raise argparse.ArgumentTypeError("not a YYYY-MM-DD date: '" + text + "'")
+
 parser = argparse.ArgumentParser()
 
 # TODO: Implement verbose and/or quiet options.
@@ -47,53 +101,888 @@ parser.add_argument('--password', help="your Garmin Connect password (otherwise,
 parser.add_argument('-c', '--count', nargs='?', default="1",
 	help="number of recent activities to download, or 'all' (default: 1)")
 
-parser.add_argument('-f', '--format', nargs='?', choices=['gpx', 'tcx', 'original'], default="gpx",
-	help="export format; can be 'gpx', 'tcx', or 'original' (default: 'gpx')")
+parser.add_argument('-f', '--format', nargs='+', choices=['gpx', 'tcx', 'original'], default=['gpx'],
+	help="export format; can be 'gpx', 'tcx', or 'original', or several of them, which are downloaded " +
+	"in one pass (default: 'gpx')")
 
 parser.add_argument('-d', '--directory', nargs='?', default=activities_directory,
 	help="the directory to export to (default: './YYYY-MM-DD_garmin_connect_export')")
 
 parser.add_argument('-u', '--unzip',
-	help="if downloading ZIP files (format: 'original'), unzip the file and removes the ZIP file",
+	help="if downloading ZIP files (format: 'original'), unzip them in the background instead of saving the ZIP files",
+	action="store_true")
+
+parser.add_argument('--after', nargs='?', type=parse_date, metavar='YYYY-MM-DD',
+	help="only export the activities that started on or after this date (local time)")
+
+parser.add_argument('--before', nargs='?', type=parse_date, metavar='YYYY-MM-DD',
+	help="only export the activities that started before this date (local time)")
+
+parser.add_argument('--type', nargs='+', metavar='TYPE',
+	help="only export the activities of these types, e.g. 'running' or 'cycling' (an activity type key, " +
+	"which includes its subtypes if it is a parent type)")
+
+parser.add_argument('-i', '--incremental',
+	help="stop at the first activity that has already been exported (according to the index in the export directory)",
 	action="store_true")
 
-args = parser.parse_args()
-
-if args.version:
-	print argv[0] + ", version " + script_version
-	exit(0)
-
-cookie_jar = cookielib.CookieJar()
-opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookie_jar))
-# print cookie_jar
-
-# url is a string, post is a dictionary of POST parameters, headers is a dictionary of headers.
-def http_req(url, post=None, headers={}):
-	request = urllib2.Request(url)
-	# request.add_header('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/1337 Safari/537.36')  # Tell Garmin we're some supported browser.
-	request.add_header('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2816.0 Safari/537.36')  # Tell Garmin we're some supported browser.
-	for header_key, header_value in headers.iteritems():
-		request.add_header(header_key, header_value)
-	if post:
-		# print "POSTING"
-		post = urlencode(post)  # Convert dictionary to POST parameter string.
-	# print request.headers
-	# print cookie_jar
-	# print post
-	# print request
-	response = opener.open(request, data=post)  # This line may throw a urllib2.HTTPError.
-
-	# N.B. urllib2 will follow any 302 redirects. Also, the "open" call above may throw a urllib2.HTTPError which is checked for below.
-	# print response.getcode()
-	if response.getcode() == 204:
-		# For activities without GPS coordinates, there is no GPX download (204 = no content).
-		# Write an empty file to prevent redownloading it.
-		print 'Writing empty file since there was no GPX activity data...'
-		return ''
-	elif response.getcode() != 200:
-		raise Exception('Bad return code (' + str(response.getcode()) + ') for: ' + url)
-
-	return response.read()
+parser.add_argument('--compress', nargs='?', choices=['gzip', 'zstd'],
+	help="compress the GPX and TCX files, activities.json and the device JSON files as they are written " +
+	"(activity_<id>.gpx.gz, or .zst with zstd, which needs the zstandard module); use gctracks.open_exported() to read them")
+
+parser.add_argument('--gpx-validation', nargs='?', choices=['full', 'fast', 'none'], default='full',
+	help="check downloaded GPX files for track points: 'full' counts them for the CSV sample count, " +
+	"'fast' stops at the first one, 'none' skips the check (default: 'full')")
+
+parser.add_argument('--summary-format', nargs='?', choices=['parquet', 'feather', 'npz'],
+	help="also save the activity summaries as typed columns in activities.parquet, activities.feather " +
+	"(both need pyarrow) or activities.npz (needs numpy)")
+
+parser.add_argument('--tracks', nargs='?', type=int, const=0, metavar='PROCESSES',
+	help="extract the track points of new data files into tracks/<activityId>.track, " +
+	"on PROCESSES processes (default: one per CPU); see gctracks.py")
+
+parser.add_argument('--enrich', nargs='?', type=int, const=0, metavar='PROCESSES',
+	help="fill in the columns of activities.csv and of the summary file that Garmin leaves empty " +
+	"(e.g. the minimum heart rate and the sample count) from the data files of the export, " +
+	"on PROCESSES processes (default: one per CPU)")
+
+parser.add_argument('--cache-ttl', nargs='?', type=float, default=30,
+	help="days to use cached activity details and device info before revalidating them (default: 30)")
+
+parser.add_argument('--cache-size', nargs='?', type=float, default=100,
+	help="maximum size of the response cache in MB (default: 100)")
+
+parser.add_argument('--no-cache', help="don't cache activity details and device info between runs", action="store_true")
+
+parser.add_argument('-n', '--dry-run',
+	help="list the activities and print what would be downloaded, without downloading or writing anything",
+	action="store_true")
+
+parser.add_argument('-w', '--workers', nargs='?', type=int, default=1,
+	help="number of activities to fetch and download in parallel (default: 1)")
+
+parser.add_argument('--rate', nargs='?', type=float, default=10,
+	help="maximum number of requests per second to send to Garmin Connect, 0 for no limit (default: 10)")
+
+parser.add_argument('--retries', nargs='?', type=int, default=5,
+	help="number of times to retry a request after a timeout, throttling or server error (default: 5)")
+
+parser.add_argument('--timeout', nargs='?', type=float, default=60,
+	help="seconds to wait for Garmin Connect to respond before retrying (default: 60)")
+
+parser.add_argument('--metrics-file', nargs='?',
+	help="write request counts, bytes, latencies and the time spent in each phase to this file at the end " +
+	"of the run: a Prometheus textfile if it ends in '.prom', JSON otherwise")
+
+parser.add_argument('--session-file', nargs='?',
+	help="file to keep the login session in between runs, so that the next runs can skip the login " +
+	"while it's valid (default: .session_cookies in the export directory)")
+
+parser.add_argument('--force-login', help="log in again even if the saved session is still valid", action="store_true")
+
+parser.add_argument('-q', '--quiet', help="don't print the progress of each activity", action="store_true")
+
+parser.add_argument('--accounts', nargs='?', metavar='FILE',
+	help="export several accounts in one process, sharing --workers, --rate and the connections: FILE has a " +
+	"section per account with its username, password and directory (default: a subdirectory of --directory " +
+	"named after the section)")
+
+parser.add_argument('--watch', nargs='?', type=float, metavar='INTERVAL',
+	help="after the export, keep running and check for new activities every INTERVAL seconds, " +
+	"with the same login session (and logging in again only once it has expired)")
+
+parser.add_argument('--server', nargs='?',
+	help="base URL of a server to use instead of Garmin Connect, such as benchmark/mock_server.py " +
+	"(e.g. 'http://127.0.0.1:8765')")
+
+# Parse the command line (sys.argv unless argv is given) into the options of an Exporter.
+def parse_options(argv=None):
+	args = parser.parse_args(argv)
+	args.format = sorted(set(args.format), key=args.format.index)
+
+	if args.summary_format in ('parquet', 'feather') and not pyarrow:
+		if not numpy:
+			parser.error('--summary-format ' + args.summary_format + ' needs pyarrow (or numpy for npz)')
+		print 'Warning: pyarrow is not installed; saving the activity summaries as npz instead of ' + args.summary_format
+		args.summary_format = 'npz'
+	elif args.summary_format == 'npz' and not numpy:
+		parser.error('--summary-format npz needs numpy')
+
+	if args.compress == 'zstd' and not zstandard:
+		parser.error('--compress zstd needs the zstandard module')
+
+	if args.after and args.before and args.after >= args.before:
+		parser.error('--after must be a date before --before')
+
+	if args.watch is not None:
+		if args.watch <= 0:
+			parser.error('--watch needs a positive number of seconds')
+		if args.dry_run or args.accounts:
+			parser.error('--watch cannot be used with --dry-run or --accounts')
+
+	return args
+
+# Upper bounds of the buckets of the request latency histograms, in seconds.
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Counters, request latency histograms and the time spent in each phase of the run, for
+# --metrics-file. Counters and requests are labelled with the kind of request (login, list,
+# details, device, download). Phases can run on several workers at once, so their seconds
+# add up the time spent on each thread; the wall time of the whole run is kept apart.
+class Metrics(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.counters = dict()
+		self.requests = dict()
+		self.phases = dict()
+
+	def count(self, name, value=1, kind=None):
+		with self.lock:
+			key = (name, kind)
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	# Set a counter to a total kept elsewhere (e.g. the connections opened by the session).
+	def set(self, name, value, kind=None):
+		with self.lock:
+			self.counters[(name, kind)] = value
+
+	def observe(self, kind, seconds):
+		with self.lock:
+			histogram = self.requests.setdefault(kind, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(latency_buckets)})
+			histogram['count'] += 1
+			histogram['sum'] += seconds
+			for i, bound in enumerate(latency_buckets):
+				if seconds <= bound:
+					histogram['buckets'][i] += 1
+
+	def add_time(self, phase, seconds):
+		with self.lock:
+			calls, total = self.phases.get(phase, (0, 0.0))
+			self.phases[phase] = (calls + 1, total + seconds)
+
+	@contextmanager
+	def phase(self, name):
+		started = time.time()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.time() - started)
+
+	def to_json(self):
+		counters = dict()
+		for (name, kind), value in self.counters.iteritems():
+			if kind:
+				counters.setdefault(name, dict())[kind] = value
+			else:
+				counters[name] = value
+		requests = dict()
+		for kind, histogram in self.requests.iteritems():
+			requests[kind] = {'count': histogram['count'], 'seconds': histogram['sum'],
+				'buckets': dict((str(bound), n) for bound, n in zip(latency_buckets, histogram['buckets']))}
+		return json.dumps({
+			'started': datetime.utcfromtimestamp(self.started).isoformat() + 'Z',
+			'seconds': time.time() - self.started,
+			'counters': counters,
+			'requests': requests,
+			'phases': dict((phase, {'calls': calls, 'seconds': seconds}) for phase, (calls, seconds) in self.phases.iteritems())},
+			indent=2, sort_keys=True) + '\n'
+
+	# The node_exporter textfile collector format.
+	def to_prometheus(self):
+		lines = []
+		lines.append('# TYPE gcexport_run_seconds gauge')
+		lines.append('gcexport_run_seconds ' + repr(time.time() - self.started))
+		lines.append('# TYPE gcexport_last_run_timestamp_seconds gauge')
+		lines.append('gcexport_last_run_timestamp_seconds ' + repr(self.started))
+		for name in sorted(set(name for name, kind in self.counters)):
+			lines.append('# TYPE gcexport_' + name + '_total counter')
+			for (counter, kind), value in sorted(self.counters.iteritems()):
+				if counter == name:
+					lines.append('gcexport_' + name + '_total' + ('{kind="' + kind + '"}' if kind else '') + ' ' + str(value))
+		lines.append('# TYPE gcexport_request_duration_seconds histogram')
+		for kind, histogram in sorted(self.requests.iteritems()):
+			for bound, n in zip(latency_buckets, histogram['buckets']):
+				lines.append('gcexport_request_duration_seconds_bucket{kind="' + kind + '",le="' + str(bound) + '"} ' + str(n))
+			lines.append('gcexport_request_duration_seconds_bucket{kind="' + kind + '",le="+Inf"} ' + str(histogram['count']))
+			lines.append('gcexport_request_duration_seconds_sum{kind="' + kind + '"} ' + repr(histogram['sum']))
+			lines.append('gcexport_request_duration_seconds_count{kind="' + kind + '"} ' + str(histogram['count']))
+		lines.append('# TYPE gcexport_phase_seconds_total counter')
+		for phase, (calls, seconds) in sorted(self.phases.iteritems()):
+			lines.append('gcexport_phase_seconds_total{phase="' + phase + '"} ' + repr(seconds))
+		lines.append('# TYPE gcexport_phase_calls_total counter')
+		for phase, (calls, seconds) in sorted(self.phases.iteritems()):
+			lines.append('gcexport_phase_calls_total{phase="' + phase + '"} ' + str(calls))
+		return '\n'.join(lines) + '\n'
+
+	def save(self, filename):
+		write_file_atomically(filename, [self.to_prometheus() if filename.endswith('.prom') else self.to_json()])
+
+# A response from HTTPSession. It decodes gzip-compressed bodies transparently and
+# hands its connection back to the pool once the body has been read completely.
+class PooledResponse(object):
+	def __init__(self, session, key, connection, response, url):
+		self.session = session
+		self.key = key
+		self.connection = connection
+		self.response = response
+		self.url = url
+		if response.getheader('Content-Encoding', '').lower() == 'gzip':
+			self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		else:
+			self.decoder = None
+
+	def getcode(self):
+		return self.response.status
+
+	def geturl(self):
+		return self.url
+
+	def info(self):
+		return self.response.msg
+
+	def read(self, amt=None):
+		if not self.connection:
+			return ''
+		while True:
+			raw = self.response.read(amt) if amt else self.response.read()
+			if not raw:
+				if self.response.length:
+					# httplib doesn't notice a body that breaks off when it's read in chunks.
+					self.close()
+					raise httplib.IncompleteRead('', self.response.length)
+				data = self.decoder.flush() if self.decoder else ''
+				self.close()
+				return data
+			data = self.decoder.decompress(raw) if self.decoder else raw
+			if data or not amt:
+				if not amt:
+					self.close()
+				return data
+
+	def close(self):
+		if not self.connection:
+			return
+		if self.response.isclosed() and not self.response.will_close:
+			self.session.release(self.key, self.connection)
+		else:
+			self.connection.close()
+		self.connection = None
+
+# Replaces a urllib2 opener: keeps a pool of persistent connections per host so that
+# consecutive requests to connect.garmin.com don't pay for a new TCP/TLS handshake,
+# and asks for gzip-compressed responses. The cookies of the login session are kept in the
+# cookie jar given to each request, so that several accounts can share the connections.
+# Like urllib2, it follows redirects, raises a urllib2.HTTPError for 4xx/5xx codes and goes
+# through the proxies of the environment (http_proxy, https_proxy and no_proxy): HTTPS
+# through a CONNECT tunnel, HTTP by sending the absolute URL to the proxy.
+class HTTPSession(object):
+	max_redirects = 10
+
+	def __init__(self, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.idle = dict()
+		self.connections_opened = 0
+		self.connections_reused = 0
+		self.proxies = urllib.getproxies()
+
+	# The proxy to use for a host, as (host:port, Proxy-Authorization header or None), or None.
+	def proxy(self, scheme, host):
+		proxy_url = self.proxies.get(scheme)
+		if not proxy_url or urllib.proxy_bypass(host.split(':')[0]):
+			return None
+		if '://' not in proxy_url:
+			proxy_url = 'http://' + proxy_url
+		proxy = urlparse(proxy_url)
+		authorization = None
+		if proxy.username:
+			authorization = 'Basic ' + base64.b64encode(urllib.unquote(proxy.username) + ':' + urllib.unquote(proxy.password or ''))
+		return proxy.hostname + (':' + str(proxy.port) if proxy.port else ''), authorization
+
+	def connect(self, key):
+		with self.lock:
+			if self.idle.get(key):
+				self.connections_reused += 1
+				return self.idle[key].pop(), True
+			self.connections_opened += 1
+		scheme, host = key
+		connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+		proxy = self.proxy(scheme, host)
+		if not proxy:
+			return connection_class(host, timeout=self.timeout), False
+		proxy_host, authorization = proxy
+		connection = connection_class(proxy_host, timeout=self.timeout)
+		if scheme == 'https':
+			connection.set_tunnel(host, headers={'Proxy-Authorization': authorization} if authorization else None)
+		return connection, False
+
+	def release(self, key, connection):
+		with self.lock:
+			self.idle.setdefault(key, []).append(connection)
+
+	def send(self, request):
+		key = (request.get_type(), request.get_host())
+		headers = dict(request.header_items())
+		selector = request.get_selector()
+		proxy = self.proxy(*key) if key[0] == 'http' else None
+		if proxy:
+			selector = request.get_full_url()
+			if proxy[1]:
+				headers['Proxy-Authorization'] = proxy[1]
+		while True:
+			connection, reused = self.connect(key)
+			try:
+				connection.request(request.get_method(), selector, request.get_data(), headers)
+				return key, connection, connection.getresponse()
+			except (httplib.HTTPException, socket.error):
+				connection.close()
+				# The server may have dropped an idle connection; retry once on a fresh one.
+				if not reused:
+					raise
+
+	def open(self, cookie_jar, url, data=None, headers={}):
+		for redirect in range(self.max_redirects + 1):
+			request = urllib2.Request(url, data)
+			for header_key, header_value in headers.iteritems():
+				request.add_header(header_key, header_value)
+			request.add_header('Accept-Encoding', 'gzip')
+			if data is not None and not request.has_header('Content-type'):
+				request.add_header('Content-type', 'application/x-www-form-urlencoded')
+			cookie_jar.add_cookie_header(request)
+			key, connection, response = self.send(request)
+			pooled_response = PooledResponse(self, key, connection, response, url)
+			cookie_jar.extract_cookies(pooled_response, request)
+
+			location = response.getheader('Location')
+			if response.status in (301, 302, 303, 307) and location:
+				pooled_response.read()
+				url = urljoin(url, location)
+				if response.status != 307:
+					data = None
+				continue
+			if response.status >= 400:
+				body = pooled_response.read()
+				raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(body))
+			return pooled_response
+		raise urllib2.HTTPError(url, response.status, 'Too many redirects', response.msg, None)
+
+# HTTP codes that mean the request may well work if it's retried a bit later.
+transient_codes = (408, 429, 500, 502, 503, 504)
+
+# Returns the delay requested by a Retry-After header (in seconds or as an HTTP date), or None.
+def retry_after(headers):
+	value = headers.getheader('Retry-After') if headers else None
+	if not value:
+		return None
+	if value.strip().isdigit():
+		return float(value)
+	date = email.utils.parsedate(value)
+	return max(0.0, calendar.timegm(date) - time.time()) if date else None
+
+# Every request goes through here. It spaces requests out with a token bucket (rate requests
+# per second, in bursts of up to a second's worth), retries timeouts, throttling and server
+# errors with exponential backoff and jitter, and holds all requests back for as long as a
+# Retry-After header asks. The number of requests in flight is adapted to the error rate:
+# halved on every transient failure and increased by one after as many successes in a row,
+# up to max_concurrency.
+class RequestScheduler(object):
+	base_delay = 1.0
+	max_delay = 60.0
+
+	def __init__(self, rate, max_concurrency, retries):
+		self.rate = rate
+		self.burst = max(1.0, rate)
+		self.tokens = self.burst
+		self.updated = time.time()
+		self.max_concurrency = max_concurrency
+		self.concurrency = max_concurrency
+		self.in_flight = 0
+		self.successes = 0
+		self.not_before = 0
+		self.retries = retries
+		self.retried = 0
+		self.condition = threading.Condition()
+
+	def acquire(self):
+		with self.condition:
+			while True:
+				now = time.time()
+				if self.rate:
+					self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if now < self.not_before:
+					timeout = self.not_before - now
+				elif self.in_flight >= self.concurrency:
+					timeout = None
+				elif self.rate and self.tokens < 1:
+					timeout = (1 - self.tokens) / self.rate
+				else:
+					self.tokens -= 1
+					self.in_flight += 1
+					return
+				self.condition.wait(timeout)
+
+	def release(self, failed):
+		with self.condition:
+			self.in_flight -= 1
+			if failed:
+				self.concurrency = max(1, self.concurrency // 2)
+				self.successes = 0
+			else:
+				self.successes += 1
+				if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+					self.concurrency += 1
+					self.successes = 0
+			self.condition.notify_all()
+
+	def pause(self, delay):
+		with self.condition:
+			self.not_before = max(self.not_before, time.time() + delay)
+			self.condition.notify_all()
+
+	def backoff(self, attempt):
+		delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+		return delay / 2 + random.uniform(0, delay / 2)
+
+	# Call send (which makes a request and returns its result) until it succeeds. HTTP errors
+	# with a code in expected_codes are the caller's to handle and are raised straight away.
+	def request(self, send, expected_codes=()):
+		attempt = 0
+		while True:
+			self.acquire()
+			failed = False
+			try:
+				return send()
+			except urllib2.HTTPError as e:
+				if e.code in expected_codes or e.code not in transient_codes:
+					raise
+				failed = True
+				if attempt >= self.retries:
+					raise
+				delay = retry_after(e.info())
+				if delay is not None:
+					self.pause(delay)
+				else:
+					delay = self.backoff(attempt)
+				error = 'HTTP ' + str(e.code)
+			except (socket.error, httplib.HTTPException) as e:
+				failed = True
+				if attempt >= self.retries:
+					raise
+				delay = self.backoff(attempt)
+				error = str(e) or e.__class__.__name__
+			finally:
+				self.release(failed)
+			attempt += 1
+			with self.condition:
+				self.retried += 1
+			print 'Request failed (' + error + '); retrying in ' + '{0:.1f}'.format(delay) + ' seconds...'
+			time.sleep(delay)
+
+# A task of a FairPool, which works like the AsyncResult of a multiprocessing pool.
+class FairTask(object):
+	def __init__(self, func, args):
+		self.func = func
+		self.args = args
+		self.done = threading.Event()
+		self.error = None
+
+	def run(self):
+		try:
+			self.value = self.func(*self.args)
+		except Exception:
+			self.error = sys.exc_info()
+		self.done.set()
+
+	def ready(self):
+		return self.done.is_set()
+
+	def get(self):
+		while not self.done.wait(1):  # With a timeout, so that Ctrl-C still gets through.
+			pass
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.value
+
+# The tasks of one account on a FairPool. It stands in for the worker pool of an Exporter:
+# terminate drops the tasks that haven't started yet and join waits for the running ones.
+class FairQueue(object):
+	def __init__(self, pool):
+		self.pool = pool
+		self.tasks = deque()
+		self.running = 0
+
+	def apply_async(self, func, args=()):
+		task = FairTask(func, args)
+		self.pool.put(self, task)
+		return task
+
+	def imap(self, func, iterable):
+		tasks = [self.apply_async(func, (item,)) for item in iterable]
+		for task in tasks:
+			yield task.get()
+
+	def close(self):
+		pass
+
+	def terminate(self):
+		with self.pool.condition:
+			self.tasks.clear()
+			if self in self.pool.turns:
+				self.pool.turns.remove(self)
+
+	def join(self):
+		with self.pool.condition:
+			while self.running:
+				self.pool.condition.wait()
+
+# A pool of worker threads shared by the exports of several accounts (--accounts). Each
+# account queues its tasks on a FairQueue of its own, and the workers take the next task of
+# each account that has some in turn, so that an account with a long backlog doesn't hold up
+# the others.
+class FairPool(object):
+	def __init__(self, processes):
+		self.condition = threading.Condition()
+		self.turns = deque()  # The queues with tasks waiting, in the order they get a worker.
+		self.closed = False
+		self.threads = [threading.Thread(target=self.work) for i in range(processes)]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def queue(self):
+		return FairQueue(self)
+
+	def put(self, queue, task):
+		with self.condition:
+			queue.tasks.append(task)
+			if queue not in self.turns:
+				self.turns.append(queue)
+			self.condition.notify_all()
+
+	def work(self):
+		while True:
+			with self.condition:
+				while not self.turns and not self.closed:
+					self.condition.wait()
+				if not self.turns:
+					return
+				queue = self.turns.popleft()
+				task = queue.tasks.popleft()
+				if queue.tasks:
+					self.turns.append(queue)
+				queue.running += 1
+			task.run()
+			with self.condition:
+				queue.running -= 1
+				self.condition.notify_all()
+
+	# Let the workers finish the tasks queued so far and stop.
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		for thread in self.threads:
+			thread.join()
+
+# Maximum number of activities you can request at once.
+# Used to be 100 and enforced by Garmin for older endpoints; for the current endpoint 'url_gc_search'
+# the limit is not known (I have less than 1000 activities and could get them all in one go)
+limit_maximum = 1000
+
+max_tries = 3
+
+WEBHOST = "https://connect.garmin.com"
+REDIRECT = "https://connect.garmin.com/post-auth/login"
+BASE_URL = "http://connect.garmin.com/en-US/signin"
+GAUTH = "http://connect.garmin.com/gauth/hostname"
+SSO = "https://sso.garmin.com/sso"
+CSS = "https://static.garmincdn.com/com.garmin.connect/ui/css/gauth-custom-v1.2-min.css"
+
+# With a server (e.g. benchmark/mock_server.py), send the requests meant for connect.garmin.com
+# and sso.garmin.com there instead.
+def server_url(url, server):
+	if not server:
+		return url
+	return re.sub(r'^https?://(connect|sso)\.garmin\.com', server.rstrip('/'), url)
+
+# A connection to Garmin Connect: the cookie jar holding the login session, the pool of
+# persistent connections and the scheduler every request goes through, plus the metrics
+# of the requests. An application can log in (or load a saved session) once and hand the
+# connection to an Exporter. max_concurrency is the number of requests in flight at most;
+# leave a slot for the listing, which is fetched while the workers download the previous page.
+# The connections of several accounts can share one HTTPSession and RequestScheduler (session
+# and scheduler; rate, timeout, retries and max_concurrency are then ignored).
+class GarminConnect(object):
+	def __init__(self, server=None, rate=10, retries=5, timeout=60, max_concurrency=2, metrics=None,
+			session=None, scheduler=None):
+		self.cookie_jar = cookielib.LWPCookieJar()
+		self.session = session if session else HTTPSession(timeout)
+		self.scheduler = scheduler if scheduler else RequestScheduler(rate, max_concurrency, retries)
+		self.metrics = metrics if metrics else Metrics()
+
+		self.login_data = {'service': server_url(REDIRECT, server),
+		    'webhost': server_url(WEBHOST, server),
+		    'source': server_url(BASE_URL, server),
+		    'redirectAfterAccountLoginUrl': server_url(REDIRECT, server),
+		    'redirectAfterAccountCreationUrl': server_url(REDIRECT, server),
+		    'gauthHost': server_url(SSO, server),
+		    'locale': 'en_US',
+		    'id': 'gauth-widget',
+		    'cssUrl': CSS,
+		    'clientId': 'GarminConnect',
+		    'rememberMeShown': 'true',
+		    'rememberMeChecked': 'false',
+		    'createAccountShown': 'true',
+		    'openCreateAccount': 'false',
+		    'usernameShown': 'false',
+		    'displayNameShown': 'false',
+		    'consumeServiceTicket': 'false',
+		    'initialFocus': 'true',
+		    'embedWidget': 'false',
+		    'generateExtraServiceTicket': 'false'}
+
+		# URLs for various services.
+		self.url_gc_login     = server_url('https://sso.garmin.com/sso/login?' + urllib.urlencode(self.login_data), server)
+		self.url_gc_post_auth = server_url('https://connect.garmin.com/modern/activities?', server)
+		self.url_gc_summary   = server_url('https://connect.garmin.com/proxy/activity-search-service-1.2/json/activities?start=0&limit=1', server)
+		self.url_gc_search    = server_url('https://connect.garmin.com/modern/proxy/activitylist-service/activities/search/activities?', server)
+		self.url_gc_activity  = server_url('https://connect.garmin.com/modern/proxy/activity-service/activity/', server)
+		self.url_gc_device    = server_url('https://connect.garmin.com/modern/proxy/device-service/deviceservice/app-info/', server)
+		self.url_gc_gpx_activity = server_url('https://connect.garmin.com/modern/proxy/download-service/export/gpx/activity/', server)
+		self.url_gc_tcx_activity = server_url('https://connect.garmin.com/modern/proxy/download-service/export/tcx/activity/', server)
+		self.url_gc_original_activity = server_url('http://connect.garmin.com/proxy/download-service/files/activity/', server)
+
+	# url is a string, post is a dictionary of POST parameters, headers is a dictionary of headers.
+	# Makes a single attempt; see http_req_stream and http_req.
+	def open_url(self, url, post=None, headers={}):
+		headers = dict(headers)
+		# headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/1337 Safari/537.36'  # Tell Garmin we're some supported browser.
+		headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2816.0 Safari/537.36'  # Tell Garmin we're some supported browser.
+		if post:
+			# print "POSTING"
+			post = urlencode(post)  # Convert dictionary to POST parameter string.
+		# print post
+		response = self.session.open(self.cookie_jar, url, data=post, headers=headers)  # This line may throw a urllib2.HTTPError.
+
+		# N.B. the session will follow any 302 redirects. Also, the "open" call above may throw a urllib2.HTTPError which is checked for below.
+		# print response.getcode()
+		if response.getcode() == 204:
+			# For activities without GPS coordinates, there is no GPX download (204 = no content).
+			# The exporter writes an empty file to prevent redownloading it.
+			pass
+		elif response.getcode() == 304 and ('If-None-Match' in headers or 'If-Modified-Since' in headers):
+			# Not modified; only returned for the conditional requests made by cached_http_req.
+			pass
+		elif response.getcode() != 200:
+			response.close()
+			raise Exception('Bad return code (' + str(response.getcode()) + ') for: ' + url)
+
+		return response
+
+	# The kind of request for the metrics, from its URL.
+	def request_kind(self, url):
+		if url.startswith(self.url_gc_search):
+			return 'list'
+		elif url.startswith(self.url_gc_activity):
+			return 'details'
+		elif url.startswith(self.url_gc_device):
+			return 'device'
+		elif url.startswith((self.url_gc_gpx_activity, self.url_gc_tcx_activity, self.url_gc_original_activity)):
+			return 'download'
+		return 'login'
+
+	# Make a request through the scheduler, recording its latency (including any retries).
+	# Responses with one of the expected_codes are answers the caller deals with, not errors.
+	def scheduled_request(self, url, send, expected_codes):
+		kind = self.request_kind(url)
+		started = time.time()
+		try:
+			return self.scheduler.request(send, expected_codes)
+		except urllib2.HTTPError as e:
+			self.metrics.count('expected_responses' if e.code in expected_codes else 'request_errors', kind=kind)
+			raise
+		except Exception:
+			self.metrics.count('request_errors', kind=kind)
+			raise
+		finally:
+			self.metrics.observe(kind, time.time() - started)
+
+	# Hands the response to receive without reading its body, so that it can be streamed to
+	# disk, and returns what receive returns. The request and receive are retried together,
+	# so that a timeout or a dropped connection while reading the body is retried as well.
+	def http_req_stream(self, url, receive, post=None, headers={}, expected_codes=()):
+		def send():
+			response = self.open_url(url, post, headers)
+			try:
+				return receive(response)
+			finally:
+				response.close()
+		return self.scheduled_request(url, send, expected_codes)
+
+	def http_req(self, url, post=None, headers={}, expected_codes=()):
+		body = self.scheduled_request(url, lambda: self.open_url(url, post, headers).read(), expected_codes)
+		self.metrics.count('response_bytes', len(body), self.request_kind(url))
+		return body
+
+	def login(self, username, password):
+		print urllib.urlencode(self.login_data)
+
+		# Initially, we need to get a valid session cookie, so we pull the login page.
+		print 'Request login page'
+		self.http_req(self.url_gc_login)
+		print 'Finish login page'
+
+		# Now we'll actually login.
+		post_data = {'username': username, 'password': password, 'embed': 'true', 'lt': 'e1s1', '_eventId': 'submit', 'displayNameRequired': 'false'}  # Fields that are passed in a typical Garmin login.
+		print 'Post login data'
+		login_response = self.http_req(self.url_gc_login, post_data)
+		print 'Finish login post'
+
+		# extract the ticket from the login response
+		pattern = re.compile(r".*\?ticket=([-\w]+)\";.*", re.MULTILINE|re.DOTALL)
+		match = pattern.match(login_response)
+		if not match:
+			raise Exception('Did not get a ticket in the login response. Cannot log in. Did you enter the correct username and password?')
+		login_ticket = match.group(1)
+		print 'login ticket=' + login_ticket
+
+		print 'Request authentication'
+		# print url_gc_post_auth + 'ticket=' + login_ticket
+		self.http_req(self.url_gc_post_auth + 'ticket=' + login_ticket)
+		print 'Finished authentication'
+
+	# The session cookies can be kept between runs (readable by the owner only), so that the
+	# next run can skip the login while the session is still valid.
+	def load(self, filename):
+		if not isfile(filename):
+			return False
+		try:
+			self.cookie_jar.load(filename, ignore_discard=True)
+		except (cookielib.LoadError, IOError):
+			print 'Warning: could not read the saved session in ' + filename
+			self.cookie_jar.clear()
+			return False
+		return len(self.cookie_jar) > 0
+
+	def save(self, filename):
+		write_file_atomically(filename,
+			['#LWP-Cookies-2.0\n', self.cookie_jar.as_lwp_str(ignore_discard=True, ignore_expires=False)], 0600)
+
+	# Check that the session cookies still work with a cheap request (the most recent activity).
+	# An expired session gets an error or the sign-in page instead of JSON.
+	def valid(self):
+		try:
+			json.loads(self.http_req(self.url_gc_search + urlencode({'start': 0, 'limit': 1}), expected_codes=(401, 403)))
+		except urllib2.HTTPError as e:
+			if e.code not in (401, 403):
+				raise
+			return False
+		except ValueError:
+			return False
+		return True
+
+# Downloads are streamed to disk in chunks of this size, so memory use doesn't depend on the file size.
+download_chunk_size = 64 * 1024
+
+def read_chunks(response):
+	while True:
+		chunk = response.read(download_chunk_size)
+		if not chunk:
+			break
+		yield chunk
+
+# Create a temporary file next to filename and open it for writing. Unlike with mkstemp
+# (which creates it readable by the owner only), the file gets mode less the umask.
+def create_temp_file(filename, mode=0666):
+	directory, basename = os.path.split(filename)
+	while True:
+		temp_filename = os.path.join(directory, '.' + basename + '.' + os.urandom(6).encode('hex') + '.part')
+		try:
+			return os.open(temp_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), mode), temp_filename
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+# Write the chunks to a temporary file next to filename, fsync it and rename it into place.
+# A download that dies halfway therefore never leaves a truncated file under the final name,
+# which the "already exists" check would otherwise mistake for a complete download.
+def write_file_atomically(filename, chunks, mode=0666):
+	fd, temp_filename = create_temp_file(filename, mode)
+	try:
+		with os.fdopen(fd, 'wb') as temp_file:
+			for chunk in chunks:
+				temp_file.write(chunk)
+			temp_file.flush()
+			os.fsync(temp_file.fileno())
+		os.rename(temp_filename, filename)
+	except:
+		remove(temp_filename)
+		raise
+
+# The suffixes of the files compressed with --compress.
+compressed_suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Compress a stream of chunks (for --compress). Nothing comes out of no data at all, so that
+# the files written when Garmin has no data stay empty, as they are without compression.
+def compress_chunks(chunks, compression):
+	compressor = None
+	for chunk in chunks:
+		if not compressor:
+			if compression == 'gzip':
+				compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			else:
+				compressor = zstandard.ZstdCompressor().compressobj()
+		yield compressor.compress(chunk)
+	if compressor:
+		yield compressor.flush()
+
+# Original archives up to this size are unzipped from memory; bigger ones spill over to an
+# anonymous temporary file, so no activity_<id>.zip is ever written to the export tree.
+unzip_spool_size = 16 * 1024 * 1024
+
+# Extract every member of a downloaded archive (a file object) into directory, each one
+# written atomically, and close the archive. Returns the names of the extracted files.
+# This runs on the unzip pool, overlapping decompression with the downloads.
+def extract_archive(archive, directory):
+	filenames = []
+	try:
+		z = zipfile.ZipFile(archive)
+		for name in z.namelist():
+			if name.endswith('/'):
+				continue
+			filename = directory + '/' + os.path.basename(name)  # Never write outside the week directory.
+			write_file_atomically(filename, read_chunks(z.open(name)))
+			filenames.append(filename)
+	finally:
+		archive.close()
+	return filenames
+
+# Linux ioctl that makes a file share the blocks of another one (copy-on-write clone), on
+# filesystems that support it (btrfs, XFS...).
+FICLONE = 0x40049409
+
+# Put a copy of filename at target without using more disk space where the filesystem allows:
+# a hard link, else a reflink, else a plain copy. Returns which one it was.
+def link_or_copy(filename, target):
+	try:
+		os.link(filename, target)
+		return 'linked'
+	except OSError as e:
+		if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+			raise
+	if fcntl:
+		try:
+			with open(filename, 'rb') as source, open(target, 'wb') as clone:
+				fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+			shutil.copystat(filename, target)
+			return 'cloned'
+		except (IOError, OSError):
+			pass
+	shutil.copy2(filename, target)
+	return 'copied'
 
 def absentOrNull(element, a):
 	if not a:
@@ -109,7 +998,7 @@ def fromActivitiesOrDetail(element, a, detail, detailContainer):
 	if absentOrNull(detailContainer, detail) or absentOrNull(element, detail[detailContainer]):
 		return None if absentOrNull(element, a) else a[element]
 	else:
-		return details[detailContainer][element]
+		return detail[detailContainer][element]
 
 def trunc6(f):
 	return "{0:12.6f}".format(floor(f*1000000)/1000000).lstrip()
@@ -138,9 +1027,15 @@ def offsetDateTime(timeLocal, timeGMT):
 	localDT = datetime.strptime(timeLocal, "%Y-%m-%d %H:%M:%S")
 	gmtDT = datetime.strptime(timeGMT, "%Y-%m-%d %H:%M:%S")
 	offset = localDT - gmtDT
-	offsetTz = FixedOffset(offset.seconds/60, "LCL")
+	offsetTz = FixedOffset(int(offset.total_seconds())/60, "LCL")
 	return localDT.replace(tzinfo=offsetTz)
 
+# the inverse for the summary columns: an 'aware' datetime from epoch milliseconds and
+# the offset in minutes east from UTC
+def localDateTime(epochMs, offsetMinutes):
+	localDT = datetime.utcfromtimestamp(epochMs / 1e3) + timedelta(minutes=offsetMinutes)
+	return localDT.replace(tzinfo=FixedOffset(offsetMinutes, "LCL"))
+
 def hhmmssFromSeconds(sec):
 	return str(timedelta(seconds=int(sec))).zfill(8)
 
@@ -182,99 +1077,312 @@ def paceOrSpeedFormatted(typeId, parentTypeId, mps):
 		return "{0:.1f}".format(round(kmh, 1))
 
 
-print 'Welcome to Garmin Connect Exporter!'
-
-# Create directory for data files.
-if isdir(args.directory):
-	print 'Warning: Output directory already exists. Will skip already-downloaded files and append to the CSV file.'
-
-username = args.username if args.username else raw_input('Username: ')
-password = args.password if args.password else getpass()
-
-# Maximum number of activities you can request at once.
-# Used to be 100 and enforced by Garmin for older endpoints; for the current endpoint 'url_gc_search'
-# the limit is not known (I have less than 1000 activities and could get them all in one go)
-limit_maximum = 1000
-
-max_tries = 3
-
-WEBHOST = "https://connect.garmin.com"
-REDIRECT = "https://connect.garmin.com/post-auth/login"
-BASE_URL = "http://connect.garmin.com/en-US/signin"
-GAUTH = "http://connect.garmin.com/gauth/hostname"
-SSO = "https://sso.garmin.com/sso"
-CSS = "https://static.garmincdn.com/com.garmin.connect/ui/css/gauth-custom-v1.2-min.css"
-
-data = {'service': REDIRECT,
-    'webhost': WEBHOST,
-    'source': BASE_URL,
-    'redirectAfterAccountLoginUrl': REDIRECT,
-    'redirectAfterAccountCreationUrl': REDIRECT,
-    'gauthHost': SSO,
-    'locale': 'en_US',
-    'id': 'gauth-widget',
-    'cssUrl': CSS,
-    'clientId': 'GarminConnect',
-    'rememberMeShown': 'true',
-    'rememberMeChecked': 'false',
-    'createAccountShown': 'true',
-    'openCreateAccount': 'false',
-    'usernameShown': 'false',
-    'displayNameShown': 'false',
-    'consumeServiceTicket': 'false',
-    'initialFocus': 'true',
-    'embedWidget': 'false',
-    'generateExtraServiceTicket': 'false'}
-
-print urllib.urlencode(data)
-
-# URLs for various services.
-url_gc_login     = 'https://sso.garmin.com/sso/login?' + urllib.urlencode(data)
-url_gc_post_auth = 'https://connect.garmin.com/modern/activities?'
-url_gc_summary   = 'https://connect.garmin.com/proxy/activity-search-service-1.2/json/activities?start=0&limit=1'
-url_gc_search    = 'https://connect.garmin.com/modern/proxy/activitylist-service/activities/search/activities?'
-url_gc_activity  = 'https://connect.garmin.com/modern/proxy/activity-service/activity/'
-url_gc_device    = 'https://connect.garmin.com/modern/proxy/device-service/deviceservice/app-info/'
-url_gc_gpx_activity = 'https://connect.garmin.com/modern/proxy/download-service/export/gpx/activity/'
-url_gc_tcx_activity = 'https://connect.garmin.com/modern/proxy/download-service/export/tcx/activity/'
-url_gc_original_activity = 'http://connect.garmin.com/proxy/download-service/files/activity/'
-
-# Initially, we need to get a valid session cookie, so we pull the login page.
-print 'Request login page'
-http_req(url_gc_login)
-print 'Finish login page'
-
-# Now we'll actually login.
-post_data = {'username': username, 'password': password, 'embed': 'true', 'lt': 'e1s1', '_eventId': 'submit', 'displayNameRequired': 'false'}  # Fields that are passed in a typical Garmin login.
-print 'Post login data'
-login_response = http_req(url_gc_login, post_data)
-print 'Finish login post'
-
-# extract the ticket from the login response
-pattern = re.compile(r".*\?ticket=([-\w]+)\";.*", re.MULTILINE|re.DOTALL)
-match = pattern.match(login_response)
-if not match:
-	raise Exception('Did not get a ticket in the login response. Cannot log in. Did you enter the correct username and password?')
-login_ticket = match.group(1)
-print 'login ticket=' + login_ticket
-
-print 'Request authentication'
-# print url_gc_post_auth + 'ticket=' + login_ticket
-http_req(url_gc_post_auth + 'ticket=' + login_ticket)
-print 'Finished authentication'
-
-# We should be logged in now.
-if not isdir(args.directory):
-	mkdir(args.directory)
-
-csv_filename = args.directory + '/activities.csv'
-csv_existed = isfile(csv_filename)
-
-csv_file = open(csv_filename, 'a')
-
-# Write header to CSV file
-if not csv_existed:
-	csv_file.write('Activity name,\
+# the value of element in a (a dict, possibly None), or None if it's absent or null
+def valueOrNone(element, a):
+	return None if absentOrNull(element, a) else a[element]
+
+# The summary of an activity, one row of the column store: typed values with timestamps in
+# epoch milliseconds, durations in seconds, distances and elevations in meters and speeds
+# in meters per second. activities.csv and the columnar summary file are both built from it.
+def summary_row(a, details, device, sample_count):
+	summary = None if absentOrNull('summaryDTO', details) else details['summaryDTO']
+	startTimeWithOffset = offsetDateTime(a['startTimeLocal'], a['startTimeGMT'])
+	elapsedDuration = valueOrNone('elapsedDuration', summary)
+
+	return {
+		'activity_id': a['activityId'],
+		'name': valueOrNone('activityName', a),
+		'description': valueOrNone('description', a),
+		'start_time': calendar.timegm(datetime.strptime(a['startTimeGMT'], "%Y-%m-%d %H:%M:%S").timetuple()) * 1000,
+		'utc_offset': int(startTimeWithOffset.utcoffset().total_seconds()) / 60,
+		'duration': elapsedDuration if elapsedDuration else valueOrNone('duration', a),
+		'moving_duration': valueOrNone('movingDuration', summary),
+		'distance': valueOrNone('distance', a),
+		'average_speed': valueOrNone('averageSpeed', a),
+		'average_moving_speed': valueOrNone('averageMovingSpeed', summary),
+		'max_speed': valueOrNone('maxSpeed', summary),
+		'elevation_corrected': bool(a.get('elevationCorrected')),
+		'elevation_gain': valueOrNone('elevationGain', summary),
+		'elevation_loss': valueOrNone('elevationLoss', summary),
+		'min_elevation': valueOrNone('minElevation', summary),
+		'max_elevation': valueOrNone('maxElevation', summary),
+		'min_hr': None,  # no minimum heart rate in JSON
+		'max_hr': valueOrNone('maxHR', a),
+		'average_hr': valueOrNone('averageHR', a),
+		'calories': valueOrNone('calories', summary),
+		'average_cadence': valueOrNone('averageBikingCadenceInRevPerMinute', a),
+		'max_cadence': valueOrNone('maxBikingCadenceInRevPerMinute', a),
+		'strokes': valueOrNone('strokes', a),
+		'average_temperature': None,  # no WeightedMeanAirTemperature in JSON
+		'min_temperature': valueOrNone('minTemperature', a),
+		'max_temperature': valueOrNone('maxTemperature', a),
+		'begin_timestamp': valueOrNone('beginTimestamp', a),
+		'device': None if absentOrNull('productDisplayName', device) else device['productDisplayName'] + ' ' + device['versionString'],
+		'activity_type': None if absentOrNull('activityType', a) else a['activityType']['typeKey'],
+		'event_type': None if absentOrNull('eventType', a) else a['eventType']['typeKey'],
+		'type_id': 4 if absentOrNull('activityType', a) else a['activityType']['typeId'],
+		'parent_type_id': 4 if absentOrNull('activityType', a) else a['activityType']['parentTypeId'],
+		# get some values from detail if present, from a otherwise
+		'start_latitude': fromActivitiesOrDetail('startLatitude', a, details, 'summaryDTO'),
+		'start_longitude': fromActivitiesOrDetail('startLongitude', a, details, 'summaryDTO'),
+		'end_latitude': fromActivitiesOrDetail('endLatitude', a, details, 'summaryDTO'),
+		'end_longitude': fromActivitiesOrDetail('endLongitude', a, details, 'summaryDTO'),
+		'sample_count': sample_count }
+
+# The line of activities.csv for a summary row.
+def csv_record(row):
+	empty_record = '"",'
+	typeId = row['type_id']
+	parentTypeId = row['parent_type_id']
+	startTimeWithOffset = localDateTime(row['start_time'], row['utc_offset'])
+	duration = row['duration']
+	durationSeconds = int(round(duration)) if duration else 0
+	endTimeWithOffset = startTimeWithOffset + timedelta(seconds=durationSeconds) if duration else None
+	corrected = row['elevation_corrected']
+
+	def quoted(value):
+		return '"' + value.replace('"', '""') + '",'
+
+	def rounded(value):
+		return '"' + str(round(value, 2)) + '",'
+
+	csv_record = ''
+
+	csv_record += empty_record if row['name'] is None else quoted(row['name'])
+	csv_record += empty_record if row['description'] is None else quoted(row['description'])
+	csv_record += '"' + startTimeWithOffset.strftime(ALMOST_RFC_1123) + '",'
+	# csv_record += '"' + startTimeWithOffset.isoformat() + '",'
+	csv_record += empty_record if not duration else hhmmssFromSeconds(round(duration)) + ','
+	csv_record += empty_record if row['moving_duration'] is None else hhmmssFromSeconds(row['moving_duration']) + ','
+	csv_record += empty_record if row['distance'] is None else '"' + "{0:.5f}".format(row['distance']/1000) + '",'
+	csv_record += empty_record if row['average_speed'] is None else '"' + trunc6(paceOrSpeedRaw(typeId, parentTypeId, row['average_speed'])) + '",'
+	csv_record += empty_record if row['average_moving_speed'] is None else '"' + trunc6(paceOrSpeedRaw(typeId, parentTypeId, row['average_moving_speed'])) + '",'
+	csv_record += empty_record if row['max_speed'] is None else '"' + trunc6(paceOrSpeedRaw(typeId, parentTypeId, row['max_speed'])) + '",'
+	csv_record += empty_record if corrected or row['elevation_loss'] is None else rounded(row['elevation_loss'])
+	csv_record += empty_record if corrected or row['elevation_gain'] is None else rounded(row['elevation_gain'])
+	csv_record += empty_record if corrected or row['min_elevation'] is None else rounded(row['min_elevation'])
+	csv_record += empty_record if corrected or row['max_elevation'] is None else rounded(row['max_elevation'])
+	csv_record += empty_record if row['min_hr'] is None else '"' + "{0:.0f}".format(row['min_hr']) + '",'
+	csv_record += empty_record if row['max_hr'] is None else '"' + "{0:.0f}".format(row['max_hr']) + '",'
+	csv_record += empty_record if row['average_hr'] is None else '"' + "{0:.0f}".format(row['average_hr']) + '",'
+	csv_record += empty_record if row['calories'] is None else '"' + "{0:.0f}".format(row['calories']) + '",'
+	csv_record += empty_record if row['average_cadence'] is None else '"' + str(row['average_cadence']) + '",'
+	csv_record += empty_record if row['max_cadence'] is None else '"' + str(row['max_cadence']) + '",'
+	csv_record += empty_record if row['strokes'] is None else '"' + str(row['strokes']) + '",'
+	csv_record += empty_record if row['average_temperature'] is None else '"' + str(row['average_temperature']) + '",'
+	csv_record += empty_record if row['min_temperature'] is None else '"' + str(row['min_temperature']) + '",'
+	csv_record += empty_record if row['max_temperature'] is None else '"' + str(row['max_temperature']) + '",'
+	csv_record += '"https://connect.garmin.com/modern/activity/' + str(row['activity_id']) + '",'
+	csv_record += empty_record if not endTimeWithOffset else '"' + endTimeWithOffset.strftime(ALMOST_RFC_1123) + '",'
+	# csv_record += empty_record if not endTimeWithOffset else '"' + endTimeWithOffset.isoformat() + '",'
+	csv_record += empty_record if row['begin_timestamp'] is None else '"' + str(row['begin_timestamp']) + '",'
+	csv_record += empty_record if row['begin_timestamp'] is None else '"' + str(row['begin_timestamp']+durationSeconds*1000) + '",'
+	csv_record += empty_record if row['device'] is None else quoted(row['device'])
+	csv_record += empty_record if row['activity_type'] is None else '"' + row['activity_type'] + '",'
+	csv_record += empty_record if row['event_type'] is None else '"' + row['event_type'] + '",'
+	csv_record += '"' + startTimeWithOffset.isoformat()[-6:] + '",'
+	csv_record += empty_record if not row['start_latitude'] else '"' + trunc6(row['start_latitude']) + '",'
+	csv_record += empty_record if not row['start_longitude'] else '"' + trunc6(row['start_longitude']) + '",'
+	csv_record += empty_record if not row['end_latitude'] else '"' + trunc6(row['end_latitude']) + '",'
+	csv_record += empty_record if not row['end_longitude'] else '"' + trunc6(row['end_longitude']) + '",'
+	csv_record += empty_record if not corrected or row['elevation_gain'] is None else rounded(row['elevation_gain'])
+	csv_record += empty_record if not corrected or row['elevation_loss'] is None else rounded(row['elevation_loss'])
+	csv_record += empty_record if not corrected or row['max_elevation'] is None else rounded(row['max_elevation'])
+	csv_record += empty_record if not corrected or row['min_elevation'] is None else rounded(row['min_elevation'])
+	csv_record += '""' if row['sample_count'] is None else '"' + str(row['sample_count']) + '"'  # no Sample Count in JSON, only in the GPX
+	csv_record += '\n'
+
+	return csv_record
+
+# The columns of the summary store and their types. 'category' columns are dictionary
+# encoded, 'timestamp' columns hold epoch milliseconds.
+summary_columns = [
+	('activity_id', 'int'),
+	('name', 'string'),
+	('description', 'string'),
+	('start_time', 'timestamp'),
+	('utc_offset', 'int'),
+	('duration', 'float'),
+	('moving_duration', 'float'),
+	('distance', 'float'),
+	('average_speed', 'float'),
+	('average_moving_speed', 'float'),
+	('max_speed', 'float'),
+	('elevation_corrected', 'bool'),
+	('elevation_gain', 'float'),
+	('elevation_loss', 'float'),
+	('min_elevation', 'float'),
+	('max_elevation', 'float'),
+	('min_hr', 'int'),
+	('max_hr', 'int'),
+	('average_hr', 'int'),
+	('calories', 'int'),
+	('average_cadence', 'float'),
+	('max_cadence', 'float'),
+	('strokes', 'int'),
+	('average_temperature', 'float'),
+	('min_temperature', 'float'),
+	('max_temperature', 'float'),
+	('begin_timestamp', 'timestamp'),
+	('device', 'category'),
+	('activity_type', 'category'),
+	('event_type', 'category'),
+	('type_id', 'int'),
+	('parent_type_id', 'int'),
+	('start_latitude', 'float'),
+	('start_longitude', 'float'),
+	('end_latitude', 'float'),
+	('end_longitude', 'float'),
+	('sample_count', 'int') ]
+
+# Summary rows gathered into columns (one list of values per column in summary_columns),
+# which can be saved as Parquet or Feather (with pyarrow) or as a NumPy .npz file. Saving
+# merges the rows into the existing file, replacing rows of the same activity_id.
+#
+# In an .npz file, missing values are NaN in float columns and -1 in int and timestamp
+# columns; a category column <name> is stored as <name> (int codes, -1 if missing) and
+# <name>_categories.
+class SummaryStore(object):
+	def __init__(self):
+		self.columns = dict((name, []) for name, type in summary_columns)
+
+	def __len__(self):
+		return len(self.columns['activity_id'])
+
+	def append(self, row):
+		for name, type in summary_columns:
+			self.columns[name].append(row[name])
+
+	def save(self, filename, format):
+		columns = self.columns
+		if isfile(filename):
+			existing = self.load(filename, format)
+			ids = set(columns['activity_id'])
+			keep = [i for i, activity_id in enumerate(existing['activity_id']) if activity_id not in ids]
+			columns = dict((name, [existing.get(name, [None] * len(existing['activity_id']))[i] for i in keep] + columns[name])
+				for name, type in summary_columns)
+		self.write(filename, format, columns)
+
+	def write(self, filename, format, columns):
+		if format == 'npz':
+			self.save_npz(filename, columns)
+		else:
+			self.save_arrow(filename, format, columns)
+
+	# Fill in the values that are missing in an existing file from the metrics of the
+	# activities (see gctracks.track_metrics), by activity id. The elevation columns are
+	# only filled in where the elevation wasn't corrected, like the uncorrected columns of
+	# activities.csv. Returns the number of rows filled in.
+	def backfill(self, filename, format, metrics):
+		columns = self.load(filename, format)
+		rows = len(columns['activity_id'])
+		for name, type in summary_columns:
+			columns.setdefault(name, [None] * rows)
+		filled = 0
+		for i, activity_id in enumerate(columns['activity_id']):
+			activity_metrics = metrics.get(activity_id)
+			if not activity_metrics:
+				continue
+			changed = False
+			for name, value in activity_metrics.iteritems():
+				if value is None or columns[name][i] is not None:
+					continue
+				if name in ('elevation_gain', 'elevation_loss', 'min_elevation', 'max_elevation') and columns['elevation_corrected'][i]:
+					continue
+				columns[name][i] = value
+				changed = True
+			filled += changed
+		if filled:
+			self.write(filename, format, columns)
+		return filled
+
+	def load(self, filename, format):
+		if format == 'npz':
+			return self.load_npz(filename)
+		if format == 'parquet':
+			table = pyarrow.parquet.read_table(filename)
+		else:
+			table = pyarrow.ipc.open_file(pyarrow.memory_map(filename)).read_all()
+		columns = dict()
+		for name in table.schema.names:
+			column = table.column(name)
+			if column.type == pyarrow.timestamp('ms'):
+				column = column.cast(pyarrow.int64())
+			columns[name] = column.to_pylist()
+		return columns
+
+	def save_arrow(self, filename, format, columns):
+		arrow_types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'bool': pyarrow.bool_(),
+			'string': pyarrow.string(), 'category': pyarrow.string(), 'timestamp': pyarrow.timestamp('ms')}
+		arrays = []
+		for name, type in summary_columns:
+			values = columns[name]
+			if type == 'int':
+				values = [None if value is None else int(round(value)) for value in values]
+			elif type == 'float':
+				values = [None if value is None else float(value) for value in values]
+			array = pyarrow.array(values, type=arrow_types[type])
+			arrays.append(array.dictionary_encode() if type == 'category' else array)
+		table = pyarrow.Table.from_arrays(arrays, [name for name, type in summary_columns])
+
+		temp_filename = filename + '.part'
+		if format == 'parquet':
+			pyarrow.parquet.write_table(table, temp_filename)
+		else:
+			sink = pyarrow.OSFile(temp_filename, 'wb')
+			writer = pyarrow.RecordBatchFileWriter(sink, table.schema)
+			writer.write_table(table)
+			writer.close()
+			sink.close()
+		os.rename(temp_filename, filename)
+
+	def save_npz(self, filename, columns):
+		arrays = dict()
+		for name, type in summary_columns:
+			values = columns[name]
+			if type == 'float':
+				arrays[name] = numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+			elif type in ('int', 'timestamp'):
+				arrays[name] = numpy.array([-1 if value is None else int(round(value)) for value in values], dtype=numpy.int64)
+			elif type == 'bool':
+				arrays[name] = numpy.array(values, dtype=numpy.bool_)
+			elif type == 'category':
+				categories = sorted(set(value for value in values if value is not None))
+				codes = dict((category, code) for code, category in enumerate(categories))
+				arrays[name] = numpy.array([codes.get(value, -1) for value in values], dtype=numpy.int32)
+				arrays[name + '_categories'] = numpy.array(categories, dtype=numpy.unicode_)
+			else:
+				arrays[name] = numpy.array([u'' if value is None else value for value in values], dtype=numpy.unicode_)
+				arrays[name + '_missing'] = numpy.array([value is None for value in values], dtype=numpy.bool_)
+
+		# numpy.savez adds '.npz' to names without it, so write through a file object.
+		temp_filename = filename + '.part'
+		with open(temp_filename, 'wb') as npz_file:
+			numpy.savez_compressed(npz_file, **arrays)
+		os.rename(temp_filename, filename)
+
+	def load_npz(self, filename):
+		arrays = numpy.load(filename)
+		columns = dict()
+		for name, type in summary_columns:
+			if name not in arrays.files:
+				continue
+			values = arrays[name].tolist()
+			if type == 'float':
+				values = [None if value != value else value for value in values]
+			elif type in ('int', 'timestamp'):
+				values = [None if value == -1 else value for value in values]
+			elif type == 'category':
+				categories = arrays[name + '_categories'].tolist()
+				values = [None if code == -1 else categories[code] for code in values]
+			elif type == 'string':
+				missing = arrays[name + '_missing'].tolist()
+				values = [None if is_missing else value for value, is_missing in zip(values, missing)]
+			columns[name] = values
+		return columns
+
+# The header line of activities.csv.
+csv_header = 'Activity name,\
 		Description,\
 		Begin timestamp,\
 		Duration (h:m:s),\
@@ -313,263 +1421,1281 @@ if not csv_existed:
 		Elevation loss corrected (m),\
 		Elevation max. corrected (m),\
 		Elevation min. corrected (m),\
-		Sample count\n')
-
-download_all = False
-if args.count == 'all':
-	# If the user wants to download all activities, first download one,
-	# then the result of that request will tell us how many are available
-	# so we will modify the variables then.
-	total_to_download = 1
-	download_all = True
-else:
-	total_to_download = int(args.count)
-total_downloaded = 0
-
-device_dict = dict()
-
-# This while loop will download data from the server in multiple chunks, if necessary.
-while total_downloaded < total_to_download:
-	# Maximum of 100... 400 return status if over 100.  So download 100 or whatever remains if less than 100.
-	if total_to_download - total_downloaded > 100:
-		num_to_download = 10
-	else:
-		num_to_download = total_to_download - total_downloaded
-
-	search_params = {'start': total_downloaded, 'limit': num_to_download}
-	# Query Garmin Connect
-	print "Making activity request ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
-	print url_gc_search + urlencode(search_params)
-	result = http_req(url_gc_search + urlencode(search_params))
-	print "Finished activity request ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
-
-	# Persist JSON
-	json_filename = args.directory + '/activities.json'
-	json_file = open(json_filename, 'a')
-	json_file.write(result)
-	json_file.close()
-
-	json_results = json.loads(result)  # TODO: Catch possible exceptions here.
-
-	# search = json_results['results']['search']
-
-	if download_all:
-		# Modify total_to_download based on how many activities the server reports.
-		total_to_download = int(json_results['results']['totalFound'])
-
-		# Do it only once.
-		download_all = False
+		Sample count\n'
+
+# The columns of activities.csv that --enrich fills in where they're empty, by index, with
+# the metric (see gctracks.track_metrics) and its format as in csv_record (the average
+# temperature is rounded, since it's a mean of the samples here). The elevation of
+# the tracks is as recorded, so it only goes to the uncorrected elevation columns.
+enriched_csv_columns = [
+	(9, 'elevation_loss', lambda value: str(round(value, 2))),
+	(10, 'elevation_gain', lambda value: str(round(value, 2))),
+	(11, 'min_elevation', lambda value: str(round(value, 2))),
+	(12, 'max_elevation', lambda value: str(round(value, 2))),
+	(13, 'min_hr', "{0:.0f}".format),
+	(14, 'max_hr', "{0:.0f}".format),
+	(15, 'average_hr', "{0:.0f}".format),
+	(20, 'average_temperature', lambda value: str(round(value, 1))),
+	(21, 'min_temperature', str),
+	(22, 'max_temperature', str),
+	(39, 'sample_count', str) ]
+
+# The line of activities.csv for the fields of a record as read by the csv module, quoted
+# like csv_record quotes them (the durations aren't quoted unless they're empty).
+def csv_line(fields):
+	return ','.join(field if i in (3, 4) and field else '"' + field.replace('"', '""') + '"'
+		for i, field in enumerate(fields)) + '\n'
+
+# Fill in the empty columns of activities.csv listed in enriched_csv_columns from the metrics
+# of the activities, by activity id (from the Map column). Returns the number of records
+# filled in.
+def backfill_csv(filename, metrics):
+	with open(filename, 'rb') as csv_file:
+		header = csv_file.readline()
+		records = list(csv.reader(csv_file))
+	filled = 0
+	for fields in records:
+		activity_metrics = metrics.get(int(fields[23].rsplit('/', 1)[-1]))
+		if not activity_metrics:
+			continue
+		changed = False
+		for i, name, format in enriched_csv_columns:
+			if not fields[i] and activity_metrics.get(name) is not None:
+				fields[i] = format(activity_metrics[name])
+				changed = True
+		filled += changed
+	if filled:
+		write_file_atomically(filename, [header] + [csv_line(fields) for fields in records])
+	return filled
+
+# Create a directory unless it already exists (another worker may have just created it).
+def ensure_directory(path):
+	try:
+		mkdir(path)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+# A persistent index of the exported activities, kept in an SQLite database in the export
+# directory. It records the summary of each activity and the data files downloaded for it
+# (per format), so that --incremental runs can stop as soon as they reach known activities.
+class ActivityIndex(object):
+	def __init__(self, filename):
+		self.connection = sqlite3.connect(filename)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS activities ('
+			'activity_id INTEGER PRIMARY KEY, name TEXT, activity_type TEXT, start_time_local TEXT, '
+			'begin_timestamp INTEGER, duration REAL, distance REAL, indexed_at TEXT)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+			'activity_id INTEGER, format TEXT, path TEXT, size INTEGER, PRIMARY KEY (activity_id, path))')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS todos (path TEXT PRIMARY KEY, name TEXT)')
+		self.connection.commit()
+
+	# Small bits of state kept between runs (e.g. the listing page size that worked last time).
+	def get_meta(self, key, default=None):
+		row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return json.loads(row[0]) if row else default
+
+	def set_meta(self, key, value):
+		self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+
+	# The manifest of the todos directory: the data files that have been put in it, by path.
+	def aggregated_files(self):
+		return set(row[0] for row in self.connection.execute('SELECT path FROM todos'))
+
+	def record_aggregated(self, filename, name):
+		self.connection.execute('INSERT OR REPLACE INTO todos VALUES (?, ?)', (filename, name))
+
+	def forget_aggregated(self):
+		self.connection.execute('DELETE FROM todos')
+
+	def files(self, activity_id, format):
+		cursor = self.connection.execute('SELECT path FROM files WHERE activity_id = ? AND format = ?', (activity_id, format))
+		return [row[0] for row in cursor]
+
+	def has_activity(self, activity_id):
+		cursor = self.connection.execute('SELECT 1 FROM files WHERE activity_id = ?', (activity_id,))
+		return cursor.fetchone() is not None
+
+	def has_format(self, activity_id, format):
+		cursor = self.connection.execute('SELECT 1 FROM files WHERE activity_id = ? AND format = ?', (activity_id, format))
+		return cursor.fetchone() is not None
+
+	def record(self, a, format, filenames):
+		self.connection.execute('INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+			a['activityId'],
+			a.get('activityName'),
+			None if absentOrNull('activityType', a) else a['activityType']['typeKey'],
+			a.get('startTimeLocal'),
+			a.get('beginTimestamp'),
+			a.get('duration'),
+			a.get('distance'),
+			datetime.now().isoformat()))
+		# A format without any file (no original file for a manual activity, with --unzip) is
+		# recorded with an empty path, so that it isn't downloaded again.
+		self.connection.execute('DELETE FROM files WHERE activity_id = ? AND format = ? AND path = ?', (a['activityId'], format, ''))
+		if not filenames:
+			self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (a['activityId'], format, '', 0))
+		for filename in filenames:
+			self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+				(a['activityId'], format, filename, os.path.getsize(filename)))
+
+	def commit(self):
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+# A persistent cache of JSON responses (activity details and devices), kept in an SQLite
+# database in the export directory. Entries are served without a request for ttl seconds;
+# after that they're revalidated with If-None-Match/If-Modified-Since where the server sent
+# an ETag or Last-Modified header. The least recently used entries are evicted once the
+# bodies take up more than max_size bytes. Workers share one instance, hence the lock.
+class ResponseCache(object):
+	def __init__(self, filename, ttl, max_size):
+		self.ttl = ttl
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(filename, check_same_thread=False)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+			'url TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, '
+			'fetched_at REAL, accessed_at REAL, size INTEGER)')
+		self.connection.commit()
+
+	# Returns (body, etag, last_modified, fresh) for url, or None if it isn't cached.
+	def get(self, url):
+		with self.lock:
+			row = self.connection.execute('SELECT body, etag, last_modified, fetched_at FROM responses WHERE url = ?', (url,)).fetchone()
+			if not row:
+				return None
+			now = time.time()
+			self.connection.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (now, url))
+			self.connection.commit()
+			return str(row[0]), row[1], row[2], now - row[3] < self.ttl
+
+	def put(self, url, body, etag, last_modified):
+		with self.lock:
+			now = time.time()
+			self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+				(url, sqlite3.Binary(body), etag, last_modified, now, now, len(body)))
+			self.evict()
+			self.connection.commit()
+
+	# The entry for url is still valid (the server answered 304 Not Modified).
+	def refresh(self, url):
+		with self.lock:
+			self.connection.execute('UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+			self.connection.commit()
+
+	def evict(self):
+		excess = self.connection.execute('SELECT TOTAL(size) FROM responses').fetchone()[0] - self.max_size
+		if excess <= 0:
+			return
+		evicted = []
+		for url, size in self.connection.execute('SELECT url, size FROM responses ORDER BY accessed_at'):
+			if excess <= 0:
+				break
+			evicted.append((url,))
+			excess -= size
+		self.connection.executemany('DELETE FROM responses WHERE url = ?', evicted)
+
+	def close(self):
+		self.connection.close()
+
+# Count the track points in a GPX file (compressed or not), streaming it (see
+# gctracks.count_track_points). With stop_at_first, stops at the first track point found.
+def count_gpx_track_points(filename, stop_at_first=False):
+	return gctracks.count_track_points(filename, stop_at_first)
+
+# Fetches the pages of the activity listing (url_gc_search). Pages start at page_size
+# activities (limit_maximum unless a smaller size was remembered from an earlier run); when
+# Garmin rejects a size with HTTP 400 it is halved until a request succeeds, then the next
+# requests bisect between the largest size accepted and the smallest rejected, and page_size
+# keeps the largest size that worked. While the caller processes a page, the next one is
+# already being requested in the background. filters are added to the parameters of each
+# request (e.g. startDate), so that Garmin only lists the matching activities.
+class ActivityPager(object):
+	def __init__(self, connection, total, page_size, progress, filters={}):
+		self.connection = connection
+		self.total = total
+		self.page_size = page_size
+		self.progress = progress
+		self.filters = filters
+		self.accepted = None
+		self.rejected = None
+		self.fetcher = ThreadPool(1)
+
+	# The page size to try next.
+	def probe_size(self):
+		if self.rejected is None:
+			return self.page_size
+		if self.accepted is None:
+			return max(1, self.rejected // 2)
+		return (self.accepted + self.rejected) // 2
+
+	def fetch(self, start, limit):
+		url_gc_search = self.connection.url_gc_search
+		while True:
+			search_params = dict(self.filters, start=start, limit=limit)
+			# Query Garmin Connect
+			self.progress("Making activity request ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+			self.progress(url_gc_search + urlencode(search_params))
+			try:
+				with self.connection.metrics.phase('listing'):
+					result = self.connection.http_req(url_gc_search + urlencode(search_params), expected_codes=(400,))
+			except urllib2.HTTPError as e:
+				if e.code != 400 or limit == 1:
+					raise
+				self.rejected = limit if self.rejected is None else min(self.rejected, limit)
+				if self.accepted is not None and self.accepted >= self.rejected:
+					self.accepted = None  # Garmin changed its mind: start halving again.
+				limit = self.probe_size()
+				print 'Page size rejected; retrying with ' + str(limit) + ' activities per page'
+				continue
+			self.progress("Finished activity request ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+			self.accepted = limit if self.accepted is None else max(self.accepted, limit)
+			if self.rejected is not None:
+				self.page_size = self.accepted
+			return result, limit
+
+	def request(self, start):
+		limit = self.probe_size() if self.total is None else min(self.probe_size(), self.total - start)
+		return self.fetcher.apply_async(self.fetch, (start, limit))
+
+	# Yields the raw JSON and the list of activities of each page, newest activities first.
+	def pages(self):
+		start = 0
+		pending = self.request(start)
+		try:
+			while pending:
+				result, limit = pending.get()
+				activities = json.loads(result)  # TODO: Catch possible exceptions here.
+				start += len(activities)
+				if len(activities) < limit or (self.total is not None and start >= self.total):
+					pending = None
+				else:
+					pending = self.request(start)
+				yield result, activities
+		finally:
+			self.fetcher.close()
+
+# Files unzipped from original archives are named after the activity (<id>.fit, <id>_ACTIVITY.fit...).
+extracted_file_pattern = re.compile(r'^(\d+)[._]')
+
+# Where the exported activities go, besides the data files. The Exporter opens its sinks
+# before the first activity, writes the record of each newly exported activity to them in
+# listing order and closes them at the end. A record is a dict with the activity as listed
+# ('activity'), its details and device info as parsed JSON ('details', 'device'; the device
+# may be None), its summary row ('summary', see summary_row), the data files it has on disk
+# ('files', and by format in 'formats') and whether any of them existed before ('new' if not).
+#
+# With --enrich, backfill is called after close with the metrics computed from the data
+# files of the whole export (see gctracks.activity_metrics), by activity id, to fill in
+# what Garmin left out of the records written in this and earlier runs.
+class Sink(object):
+	def open(self, exporter):
+		pass
+
+	def write(self, record):
+		pass
+
+	def close(self):
+		pass
+
+	def backfill(self, metrics):
+		pass
+
+# All the data files of a record, over its formats.
+def record_files(record):
+	return [filename for format in sorted(record['formats']) for filename in record['formats'][format]]
+
+# Appends a line per activity to activities.csv (or filename), writing the header first
+# if the file is new.
+class CsvSink(Sink):
+	def __init__(self, filename=None):
+		self.filename = filename
+
+	def open(self, exporter):
+		self.filename = self.filename or exporter.options.directory + '/activities.csv'
+		self.metrics = exporter.metrics
+		csv_existed = isfile(self.filename)
+		self.csv_file = open(self.filename, 'a')
+		# Write header to CSV file
+		if not csv_existed:
+			self.csv_file.write(csv_header)
+
+	def write(self, record):
+		self.csv_file.write(csv_record(record['summary']).encode('utf8'))
+
+	def close(self):
+		self.csv_file.close()
+
+	def backfill(self, metrics):
+		with self.metrics.phase('enrich'):
+			filled = backfill_csv(self.filename, metrics)
+		print 'Filled in ' + str(filled) + ' activities in ' + self.filename
+
+# Saves the summary rows as typed columns (see SummaryStore) in activities.<format> (or filename).
+class SummarySink(Sink):
+	def __init__(self, format, filename=None):
+		self.format = format
+		self.filename = filename
+
+	def open(self, exporter):
+		self.filename = self.filename or exporter.options.directory + '/activities.' + self.format
+		self.metrics = exporter.metrics
+		self.summary_store = SummaryStore()
+
+	def write(self, record):
+		self.summary_store.append(record['summary'])
+
+	def close(self):
+		if len(self.summary_store):
+			with self.metrics.phase('summaries'):
+				self.summary_store.save(self.filename, self.format)
+
+	def backfill(self, metrics):
+		if isfile(self.filename):
+			with self.metrics.phase('enrich'):
+				filled = SummaryStore().backfill(self.filename, self.format, metrics)
+			print 'Filled in ' + str(filled) + ' activities in ' + self.filename
+
+# Exports the activities of the account that connection (a GarminConnect, logged in) is
+# logged in to, with options as returned by parse_options: the data files go to the week
+# directories of options.directory and the records of the exported activities to sinks.
+# iter_activities yields the records as they come in; run just exports everything. The
+# activities are processed on a pool of options.workers threads, or on worker_pool if
+# given (e.g. the FairQueue of the account on a FairPool shared with other accounts).
+class Exporter(object):
+	# At most this many records are held back behind an archive that is still being unzipped.
+	max_unfinished = 100
+	# Taken to print the output held back for an activity (shared by the exporters of all accounts).
+	progress_lock = threading.Lock()
+
+	def __init__(self, connection, options, sinks=(), worker_pool=None):
+		self.connection = connection
+		self.options = options
+		self.sinks = list(sinks)
+		self.shared_worker_pool = worker_pool
+		self.metrics = connection.metrics
+
+		if options.count == 'all':
+			# The listing doesn't tell how many activities there are; the pager stops at the first short page.
+			self.total_to_download = None
+		else:
+			self.total_to_download = int(options.count)
+
+		self.held_progress = threading.local()
+		self.device_dict = dict()
+		self.device_lock = threading.Lock()
+		self.device_locks = dict()
+
+		self.compressed_suffix = compressed_suffixes.get(options.compress, '')
+
+	# Per-activity progress output, which --quiet leaves out. With newline=False, the next
+	# message goes on the same line, like a print statement ending in a comma. Inside
+	# holding_progress, the output is held back instead.
+	def progress(self, message, newline=True):
+		if self.options.quiet:
+			return
+		held = getattr(self.held_progress, 'fragments', None)
+		if held is not None:
+			held.append(message + ('\n' if newline else ' '))
+		elif newline:
+			print message
+		else:
+			print message,
+
+	# On the worker pool, hold back the progress output of the activity processed by this
+	# thread and print it in one go, so that the lines of concurrent activities don't interleave.
+	@contextmanager
+	def holding_progress(self):
+		if not self.worker_pool:
+			yield
+			return
+		self.held_progress.fragments = []
+		try:
+			yield
+		finally:
+			output = ''.join(self.held_progress.fragments)
+			self.held_progress.fragments = None
+			if output:
+				with self.progress_lock:
+					sys.stdout.write(output if output.endswith('\n') else output + '\n')
+
+	# Like http_req, but serves the response from response_cache if possible. With refresh,
+	# the cached response is ignored (and replaced), e.g. when it turned out to be incomplete.
+	def cached_http_req(self, url, refresh=False):
+		connection = self.connection
+		response_cache = self.response_cache
+		if not response_cache:
+			return connection.http_req(url)
+
+		entry = None if refresh else response_cache.get(url)
+		headers = dict()
+		if entry:
+			body, etag, last_modified, fresh = entry
+			if fresh:
+				self.metrics.count('cache_hits', kind=connection.request_kind(url))
+				return body
+			if etag:
+				headers['If-None-Match'] = etag
+			if last_modified:
+				headers['If-Modified-Since'] = last_modified
+
+		code, response_body, info = connection.http_req_stream(url,
+			lambda response: (response.getcode(), response.read(), response.info()), headers=headers)
+		if code == 304:
+			response_cache.refresh(url)
+			self.metrics.count('cache_revalidations', kind=connection.request_kind(url))
+			return body
+
+		body = response_body
+		self.metrics.count('response_bytes', len(body), connection.request_kind(url))
+		response_cache.put(url, body, info.getheader('ETag'), info.getheader('Last-Modified'))
+		return body
+
+	# The chunks to write to a file, compressed with --compress.
+	def compress(self, chunks):
+		return compress_chunks(chunks, self.options.compress) if self.options.compress else chunks
+
+	# Fetch the device details for an application installation id, caching them in
+	# device_dict as they're used for multiple activities. Each device has a lock, held while
+	# fetching it, so that concurrent workers don't request the same device twice but don't
+	# wait for the other devices either.
+	def get_device(self, device_app_inst_id):
+		with self.device_lock:
+			if self.device_dict.has_key(device_app_inst_id):
+				return self.device_dict[device_app_inst_id]
+			lock = self.device_locks.setdefault(device_app_inst_id, threading.Lock())
+		with lock:
+			if not self.device_dict.has_key(device_app_inst_id):
+				# print '\tGetting device details ' + str(device_app_inst_id)
+				device_details = self.cached_http_req(self.connection.url_gc_device + str(device_app_inst_id))
+				device_filename = self.options.directory + '/device_' + str(device_app_inst_id) + '.json' + self.compressed_suffix
+				write_file_atomically(device_filename, self.compress([device_details]))
+				self.device_dict[device_app_inst_id] = None if not device_details else json.loads(device_details)
+			return self.device_dict[device_app_inst_id]
+
+	# The directory the data files of an activity go to (one per ISO week).
+	def week_directory(self, a):
+		date = datetime.fromtimestamp(a['beginTimestamp'] / 1e3)
+		return self.options.directory + str(date.year) + "-Semana" + str(date.isocalendar()[1])
+
+	# Scan the export tree once, returning the set of existing week directories, the set of
+	# files in them and the files that look unzipped from an original archive, by activity ID.
+	# Planning checks these instead of stat-ing every file.
+	def scan_export_directory(self):
+		directories = set(filter(isdir, glob.glob(self.options.directory + '[0-9][0-9][0-9][0-9]-Semana*')))
+		filenames = set()
+		extracted = {}
+		for directory in directories:
+			for name in os.listdir(directory):
+				filenames.add(directory + '/' + name)
+				match = extracted_file_pattern.match(name)
+				if match and not name.endswith('.part'):
+					extracted.setdefault(match.group(1), []).append(directory + '/' + name)
+		return directories, filenames, extracted
+
+	# The download of one format of an activity: the data file name and download URL, and the
+	# existing files if it has been downloaded before (an empty list if Garmin had no file for
+	# it, None if it hasn't been downloaded).
+	def plan_download(self, a, format, newDirectory):
+		connection = self.connection
+		download = {'format': format}
+		existing_filenames = None
+		if format == 'gpx':
+			download['data_filename'] = newDirectory + '/activity_' + str(a['activityId']) + '.gpx'
+			download['download_url'] = connection.url_gc_gpx_activity + str(a['activityId']) + '?full=true'
+		elif format == 'tcx':
+			download['data_filename'] = newDirectory + '/activity_' + str(a['activityId']) + '.tcx'
+			download['download_url'] = connection.url_gc_tcx_activity + str(a['activityId']) + '?full=true'
+		elif format == 'original':
+			download['data_filename'] = newDirectory + '/activity_' + str(a['activityId']) + '.zip'
+			download['download_url'] = connection.url_gc_original_activity + str(a['activityId'])
+			# Regardless of unzip setting, don't redownload if the ZIP or the files extracted from it exist.
+			# The members are whatever the index recorded when they were extracted, or, for exports older
+			# than the index, files in the week directory named after the activity ID (<id>.fit, <id>_ACTIVITY.fit...).
+			recorded = self.activity_index.files(a['activityId'], 'original')
+			members = [filename for filename in recorded if filename in self.existing_files]
+			if not members:
+				members = [filename for filename in self.extracted_files.get(str(a['activityId']), []) if filename.startswith(newDirectory + '/')]
+			if members:
+				existing_filenames = members
+			elif '' in recorded:
+				# Garmin had nothing to unzip for it last time (see ActivityIndex.record).
+				existing_filenames = []
+		else:
+			raise Exception('Unrecognized format.')
 
-	# Pull out just the list of activities.
-	activities = json_results
+		# GPX and TCX files count as downloaded whether they have been compressed (--compress) or not.
+		if format in ('gpx', 'tcx'):
+			candidates = [download['data_filename'] + suffix for suffix in [''] + sorted(compressed_suffixes.values())]
+			download['data_filename'] += self.compressed_suffix
+		else:
+			candidates = [download['data_filename']]
+		for filename in candidates:
+			if filename in self.existing_files:
+				existing_filenames = [filename]
+				break
+		return download, existing_filenames
+
+	# Work out what needs to be done for a listed activity without touching the network or
+	# the filesystem. Returns a dict with the activity, its week directory, the downloads of
+	# the formats that haven't been downloaded yet and the existing files of the others, by format.
+	#
+	# An activity with files on disk that aren't in the index, written since the index was
+	# created, is one whose export was cut short before it got its record ('unrecorded'): it
+	# still needs its details and a record, like a new one.
+	def plan_activity(self, a):
+		newDirectory = self.week_directory(a)
+		plan = {'activity': a, 'directory': newDirectory, 'downloads': [], 'existing': dict(), 'unrecorded': False}
+		for format in self.options.format:
+			download, existing_filenames = self.plan_download(a, format, newDirectory)
+			if existing_filenames is not None:
+				plan['existing'][format] = existing_filenames
+			else:
+				plan['downloads'].append(download)
+		if plan['existing'] and not self.activity_index.has_activity(a['activityId']):
+			existing_files = [filename for filenames in plan['existing'].itervalues() for filename in filenames]
+			plan['unrecorded'] = any(getmtime(filename) >= self.index_created for filename in existing_files)
+		return plan
+
+	# Plan a page of listed activities and create the week directories that are still missing
+	# in one go. Returns the plans of all activities; the ones to download have downloads.
+	def plan_page(self, activities):
+		plans = [self.plan_activity(a) for a in activities]
+		new_directories = set(plan['directory'] for plan in plans if plan['downloads']) - self.existing_directories
+		if not self.options.dry_run:
+			for directory in sorted(new_directories):
+				ensure_directory(directory)
+		self.existing_directories.update(new_directories)
+		return plans
+
+	# process_activity for the worker pool, with its progress output held back: the record is
+	# kept in completed until imap hands it back, so that close can still write it if the
+	# export fails in the meantime.
+	def process_planned(self, plan):
+		with self.holding_progress():
+			processed = self.process_activity(plan)
+		with self.completed_lock:
+			self.completed[plan['activity']['activityId']] = processed
+		return processed
+
+	# Fetch the details of a single activity and download its data files, as planned by
+	# plan_activity: the details and the device are fetched once for all formats. Returns the
+	# record of the activity and, for an archive being unzipped on the unzip pool, the
+	# AsyncResult that will hand over the extracted files (the record's files are filled in
+	# from it). This runs on the worker pool when --workers is greater than 1.
+	def process_activity(self, plan):
+		progress = self.progress
+		metrics = self.metrics
+		a = plan['activity']
 
-	# Process each activity.
-	for a in activities:
 		# Display which entry we're working on.
-		print 'Garmin Connect activity: [' + str(a['activityId']) + ']',
-		print a['activityName']
-		
+		progress('Garmin Connect activity: [' + str(a['activityId']) + ']', newline=False)
+		progress(a['activityName'])
+
 		activity_details = None
 		details = None
 		tries = max_tries
-		while tries > 0:
-			activity_details = http_req(url_gc_activity + str(a['activityId']))
-			details = json.loads(activity_details)
-			# I observed a failure to get a complete JSON detail in about 5-10 calls out of 1000
-			# retrying then statistically gets a better JSON ;-)
-			if len(details['summaryDTO']) > 0:
-				tries = 0
-			else:
-				print 'retrying for ' + str(a['activityId'])
-				tries -= 1
-				if tries == 0:
-					raise Exception('Didn\'t get "summaryDTO" after ' + str(max_tries) + ' tries for ' + str(a['activityId']))
-
-		parentTypeId = 4 if absentOrNull('activityType', a) else a['activityType']['parentTypeId']
-		typeId = 4 if absentOrNull('activityType', a) else a['activityType']['typeId']
+		with metrics.phase('details'):
+			while tries > 0:
+				activity_details = self.cached_http_req(self.connection.url_gc_activity + str(a['activityId']), refresh=tries < max_tries)
+				details = json.loads(activity_details)
+				# I observed a failure to get a complete JSON detail in about 5-10 calls out of 1000
+				# retrying then statistically gets a better JSON ;-)
+				if len(details['summaryDTO']) > 0:
+					tries = 0
+				else:
+					print 'retrying for ' + str(a['activityId'])
+					tries -= 1
+					if tries == 0:
+						raise Exception('Didn\'t get "summaryDTO" after ' + str(max_tries) + ' tries for ' + str(a['activityId']))
 
 		startTimeWithOffset = offsetDateTime(a['startTimeLocal'], a['startTimeGMT'])
 
-		elapsedDuration = details['summaryDTO']['elapsedDuration'] if details['summaryDTO'] else None
-		duration = elapsedDuration if elapsedDuration else a['duration']
-		durationSeconds = int(round(duration))
-		endTimeWithOffset = startTimeWithOffset + timedelta(seconds=durationSeconds) if duration else None
-
-		# get some values from detail if present, from a otherwise
-		startLatitude = fromActivitiesOrDetail('startLatitude', a, details, 'summaryDTO')
-		startLongitude = fromActivitiesOrDetail('startLongitude', a, details, 'summaryDTO')
-		endLatitude = fromActivitiesOrDetail('endLatitude', a, details, 'summaryDTO')
-		endLongitude = fromActivitiesOrDetail('endLongitude', a, details, 'summaryDTO')
-
-		print '\t' + startTimeWithOffset.isoformat() + ',',
+		progress('\t' + startTimeWithOffset.isoformat() + ',', newline=False)
 		if 'duration' in a:
-			print hhmmssFromSeconds(a['duration']) + ',',
+			progress(hhmmssFromSeconds(a['duration']) + ',', newline=False)
 		else:
-			print '??:??:??,',
+			progress('??:??:??,', newline=False)
 		if 'distance' in a:
-			print "{0:.3f}".format(a['distance']/1000)
+			progress("{0:.3f}".format(a['distance']/1000))
 		else:
-			print '0.000 km'
+			progress('0.000 km')
 
 		# try to get the device details (and cache them, as they're used for multiple activities)
-		device = None
 		device_app_inst_id = None if absentOrNull('metadataDTO', details) else details['metadataDTO']['deviceApplicationInstallationId']
-		if device_app_inst_id:
-			if not (device_dict.has_key(device_app_inst_id)):
-				# print '\tGetting device details ' + str(device_app_inst_id)
-				device_details = http_req(url_gc_device + str(device_app_inst_id))
-				device_filename = args.directory + '/device_' + str(device_app_inst_id) + '.json'
-				device_file = open(device_filename, 'a')
-				device_file.write(device_details)
-				device_file.close()
-				device_dict[device_app_inst_id] = None if not device_details else json.loads(device_details)
-			device = device_dict[device_app_inst_id]
-
-
-		date = datetime.fromtimestamp(a['beginTimestamp'] / 1e3)
-
-		newDirectory = args.directory + str(date.year) + "-Semana" + str(date.isocalendar()[1])
-		if not isdir(newDirectory):
-			mkdir(newDirectory)
-
-		if args.format == 'gpx':
-			data_filename = newDirectory + '/activity_' + str(a['activityId']) + '.gpx'
-			download_url = url_gc_gpx_activity + str(a['activityId']) + '?full=true'
-			file_mode = 'w'
-		elif args.format == 'tcx':
-			data_filename = newDirectory + '/activity_' + str(a['activityId']) + '.tcx'
-			download_url = url_gc_tcx_activity + str(a['activityId']) + '?full=true'
-			file_mode = 'w'
-		elif args.format == 'original':
-			data_filename = newDirectory + '/activity_' + str(a['activityId']) + '.zip'
-			fit_filename = newDirectory + '/' + str(a['activityId']) + '.fit'
-			download_url = url_gc_original_activity + str(a['activityId'])
-			file_mode = 'wb'
-		else:
-			raise Exception('Unrecognized format.')
-
-		if isfile(data_filename):
-			print '\tData file already exists; skipping...'
-			continue
-		if args.format == 'original' and isfile(fit_filename):  # Regardless of unzip setting, don't redownload if the ZIP or FIT file exists.
-			print '\tFIT data file already exists; skipping...'
-			continue
+		with metrics.phase('device'):
+			device = self.get_device(device_app_inst_id) if device_app_inst_id else None
+
+		# An activity is new unless a format of it had been downloaded before (and it's only
+		# being exported again for the formats added since).
+		record = {'activity': a, 'details': details, 'device': device, 'formats': dict(plan['existing']),
+			'new': not plan['existing'] or plan['unrecorded']}
+		sample_count = None
+		extraction = None
+		gpx_files = plan['existing'].get('gpx')
+		if plan['unrecorded'] and gpx_files and self.options.gpx_validation == 'full':
+			with metrics.phase('validation'):
+				sample_count = count_gpx_track_points(gpx_files[0], False)
+		for download in plan['downloads']:
+			filenames, track_points, archive = self.download_file(download, plan['directory'])
+			record['formats'][download['format']] = filenames
+			if track_points is not None:
+				sample_count = track_points
+			if archive:
+				extraction = archive
+
+		record['summary'] = summary_row(a, details, device, sample_count)
+		record['files'] = record_files(record)
+		return record, extraction
+
+	# Download one data file of an activity. Returns the files written, the number of track
+	# points for the CSV sample count (or None) and, for an archive being unzipped on the
+	# unzip pool, the AsyncResult that will hand over the extracted files.
+	def download_file(self, download, newDirectory):
+		options = self.options
+		progress = self.progress
+		metrics = self.metrics
+		format = download['format']
+		data_filename = download['data_filename']
+		download_url = download['download_url']
 
 		# Download the data file from Garmin Connect.
-		# If the download fails (e.g., due to timeout), this script will die, but nothing
-		# will have been written to disk about this activity, so just running it again
-		# should pick up where it left off.
-		print '\tDownloading file...',
+		# If the download fails (e.g., due to timeout) even after the retries, this script will
+		# die, but nothing will have been written to disk about this activity, so just running
+		# it again should pick up where it left off.
+		if len(options.format) > 1:
+			progress('\tDownloading ' + format + ' file...', newline=False)
+		else:
+			progress('\tDownloading file...', newline=False)
+		download_started = time.time()
+		unzip = format == 'original' and options.unzip
+
+		# Receive the body of the response (or nothing, for None): as an archive to unzip or
+		# straight into the data file. The request is retried with it, so a body that breaks
+		# off midway is downloaded again from the start. Returns the archive (or None) and the
+		# number of bytes received.
+		def receive(response):
+			if response and response.getcode() == 204:
+				# For activities without GPS coordinates, there is no GPX download (204 = no content).
+				# Write an empty file to prevent redownloading it.
+				progress('Writing empty file since there was no GPX activity data...')
+			chunks = read_chunks(response) if response else []
+
+			if unzip:
+				# Even manual uploads of a GPX file are zipped. Keep the archive off the export tree and unzip
+				# it on the unzip pool, so the next download doesn't have to wait for the decompression.
+				archive = tempfile.SpooledTemporaryFile(unzip_spool_size)
+				try:
+					for chunk in chunks:
+						archive.write(chunk)
+				except Exception:
+					archive.close()
+					raise
+				return archive, archive.tell()
+
+			downloaded = [0]
+			def counted_chunks():
+				for chunk in chunks:
+					downloaded[0] += len(chunk)
+					yield chunk
+			write_file_atomically(data_filename, self.compress(counted_chunks()))
+			return None, downloaded[0]
 
 		try:
-			data = http_req(download_url)
+			# Don't retry the errors handled below.
+			archive, size = self.connection.http_req_stream(download_url, receive,
+				expected_codes={'tcx': (500,), 'original': (404,)}.get(format, ()))
 		except urllib2.HTTPError as e:
 			# Handle expected (though unfortunate) error codes; die on unexpected ones.
-			if e.code == 500 and args.format == 'tcx':
+			if e.code == 500 and format == 'tcx':
 				# Garmin will give an internal server error (HTTP 500) when downloading TCX files if the original was a manual GPX upload.
 				# Writing an empty file prevents this file from being redownloaded, similar to the way GPX files are saved even when there are no tracks.
 				# One could be generated here, but that's a bit much. Use the GPX format if you want actual data in every file,
 				# as I believe Garmin provides a GPX file for every activity.
-				print 'Writing empty file since Garmin did not generate a TCX file for this activity...',
-				data = ''
-			elif e.code == 404 and args.format == 'original':
+				progress('Writing empty file since Garmin did not generate a TCX file for this activity...', newline=False)
+			elif e.code == 404 and format == 'original':
 				# For manual activities (i.e., entered in online without a file upload), there is no original file.
 				# Write an empty file to prevent redownloading it.
-				print 'Writing empty file since there was no original activity data...',
-				data = ''
+				progress('Writing empty file since there was no original activity data...', newline=False)
 			else:
 				raise Exception('Failed. Got an unexpected HTTP error (' + str(e.code) + download_url +').')
-
-		save_file = open(data_filename, file_mode)
-		save_file.write(data)
-		save_file.close()
-
-		# Write stats to CSV.
-		empty_record = '"",'
-
-		csv_record = ''
-
-		csv_record += empty_record if absentOrNull('activityName', a) else '"' + a['activityName'].replace('"', '""') + '",'
-		csv_record += empty_record if absentOrNull('description', a) else '"' + a['description'].replace('"', '""') + '",'
-		csv_record += '"' + startTimeWithOffset.strftime(ALMOST_RFC_1123) + '",'
-		# csv_record += '"' + startTimeWithOffset.isoformat() + '",'
-		csv_record += empty_record if not duration else hhmmssFromSeconds(round(duration)) + ','
-		csv_record += empty_record if absentOrNull('summaryDTO', details) or absentOrNull('movingDuration', details['summaryDTO']) else hhmmssFromSeconds(details['summaryDTO']['movingDuration']) + ','
-		csv_record += empty_record if absentOrNull('distance', a) else '"' + "{0:.5f}".format(a['distance']/1000) + '",'
-		csv_record += empty_record if absentOrNull('averageSpeed', a) else '"' + trunc6(paceOrSpeedRaw(typeId, parentTypeId, a['averageSpeed'])) + '",'
-		csv_record += empty_record if absentOrNull('summaryDTO', details) or absentOrNull('averageMovingSpeed', details['summaryDTO']) else '"' + trunc6(paceOrSpeedRaw(typeId, parentTypeId, details['summaryDTO']['averageMovingSpeed'])) + '",'
-		csv_record += empty_record if absentOrNull('summaryDTO', details) or absentOrNull('maxSpeed', details['summaryDTO']) else '"' + trunc6(paceOrSpeedRaw(typeId, parentTypeId, details['summaryDTO']['maxSpeed'])) + '",'
-		csv_record += empty_record if a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('elevationLoss', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['elevationLoss'], 2)) + '",'
-		csv_record += empty_record if a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('elevationGain', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['elevationGain'], 2)) + '",'
-		csv_record += empty_record if a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('minElevation', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['minElevation'], 2)) + '",'
-		csv_record += empty_record if a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('maxElevation', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['maxElevation'], 2)) + '",'
-		csv_record += empty_record # no minimum heart rate in JSON
-		csv_record += empty_record if absentOrNull('maxHR', a) else '"' + "{0:.0f}".format(a['maxHR']) + '",'
-		csv_record += empty_record if absentOrNull('averageHR', a) else '"' + "{0:.0f}".format(a['averageHR']) + '",'
-		csv_record += empty_record if absentOrNull('summaryDTO', details) or absentOrNull('calories', details['summaryDTO']) else '"' + "{0:.0f}".format(details['summaryDTO']['calories']) + '",'
-		csv_record += empty_record if absentOrNull('averageBikingCadenceInRevPerMinute', a) else '"' + str(a['averageBikingCadenceInRevPerMinute']) + '",'
-		csv_record += empty_record if absentOrNull('maxBikingCadenceInRevPerMinute', a) else '"' + str(a['maxBikingCadenceInRevPerMinute']) + '",'
-		csv_record += empty_record if absentOrNull('strokes', a) else '"' + str(a['strokes']) + '",'
-		csv_record += empty_record # no WeightedMeanAirTemperature in JSON
-		csv_record += empty_record if absentOrNull('minTemperature', a) else '"' + str(a['minTemperature']) + '",'
-		csv_record += empty_record if absentOrNull('maxTemperature', a) else '"' + str(a['maxTemperature']) + '",'
-		csv_record += '"https://connect.garmin.com/modern/activity/' + str(a['activityId']) + '",'
-		csv_record += empty_record if not endTimeWithOffset else '"' + endTimeWithOffset.strftime(ALMOST_RFC_1123) + '",'
-		# csv_record += empty_record if not endTimeWithOffset else '"' + endTimeWithOffset.isoformat() + '",'
-		csv_record += empty_record if absentOrNull('beginTimestamp', a) else '"' + str(a['beginTimestamp']) + '",'
-		csv_record += empty_record if absentOrNull('beginTimestamp', a) else '"' + str(a['beginTimestamp']+durationSeconds*1000) + '",'
-		csv_record += empty_record if absentOrNull('productDisplayName', device) else '"' + device['productDisplayName'].replace('"', '""') + ' ' + device['versionString'] + '",'
-		csv_record += empty_record if absentOrNull('activityType', a) else '"' + a['activityType']['typeKey'] + '",'
-		csv_record += empty_record if absentOrNull('eventType', a) else '"' + a['eventType']['typeKey'] + '",'
-		csv_record += '"' + startTimeWithOffset.isoformat()[-6:] + '",'
-		csv_record += empty_record if not startLatitude else '"' + trunc6(startLatitude) + '",'
-		csv_record += empty_record if not startLongitude else '"' + trunc6(startLongitude) + '",'
-		csv_record += empty_record if not endLatitude else '"' + trunc6(endLatitude) + '",'
-		csv_record += empty_record if not endLongitude else '"' + trunc6(endLongitude) + '",'
-		csv_record += empty_record if not a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('elevationGain', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['elevationGain'], 2)) + '",'
-		csv_record += empty_record if not a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('elevationLoss', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['elevationLoss'], 2)) + '",'
-		csv_record += empty_record if not a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('maxElevation', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['maxElevation'], 2)) + '",'
-		csv_record += empty_record if not a['elevationCorrected'] or absentOrNull('summaryDTO', details) or absentOrNull('minElevation', details['summaryDTO']) else '"' + str(round(details['summaryDTO']['minElevation'], 2)) + '",'
-		csv_record += '""'         # no Sample Count in JSON
-		csv_record += '\n'
-
-		csv_file.write(csv_record.encode('utf8'))
-
-		if args.format == 'gpx':
+			archive, size = receive(None)
+		metrics.count('response_bytes', size, 'download')
+		metrics.add_time('download', time.time() - download_started)
+
+		if unzip:
+			if size == 0:
+				progress('Skipping 0Kb zip file.')
+				archive.close()
+				return [], None, None
+			progress('Unzipping ' + str(size) + ' bytes in the background.')
+			archive.seek(0)
+			return [], None, self.unzip_pool.apply_async(self.extract_archive, (archive, newDirectory))
+
+		sample_count = None
+		if format == 'gpx' and options.gpx_validation != 'none':
 			# Validate GPX data. If we have an activity without GPS data (e.g., running on a treadmill),
 			# Garmin Connect still kicks out a GPX, but there is only activity information, no GPS data.
-			# N.B. You can omit the XML parse (and the associated log messages) to speed things up.
-			gpx = parseString(data)
-			gpx_data_exists = len(gpx.getElementsByTagName('trkpt')) > 0
-
-			if gpx_data_exists:
-				print 'Done. GPX data saved.'
+			# N.B. Use '--gpx-validation fast' (or 'none') to speed things up.
+			with metrics.phase('validation'):
+				track_points = count_gpx_track_points(data_filename, options.gpx_validation == 'fast')
+			if options.gpx_validation == 'full':
+				sample_count = track_points
+
+			if track_points > 0:
+				progress('Done. GPX data saved.')
 			else:
-				print 'Done. No track points found.'
-		elif args.format == 'original':
-			if args.unzip and data_filename[-3:].lower() == 'zip':  # Even manual upload of a GPX file is zipped, but we'll validate the extension.
-				print "Unzipping and removing original files...",
-				print 'Filesize is: ' + str(stat(data_filename).st_size)
-				if stat(data_filename).st_size > 0:
-					zip_file = open(data_filename, 'rb')
-					z = zipfile.ZipFile(zip_file)
-					for name in z.namelist():
-						z.extract(name, newDirectory)
-					zip_file.close()
-				else:
-					print 'Skipping 0Kb zip file.'
-				remove(data_filename)
-			print 'Done.'
+				progress('Done. No track points found.')
 		else:
 			# TODO: Consider validating other formats.
-			print 'Done.'
-	total_downloaded += num_to_download
-# End while loop for multiple chunks.
+			progress('Done.')
+
+		return [data_filename], sample_count, None
+
+	def extract_archive(self, archive, directory):
+		with self.metrics.phase('unzip'):
+			return extract_archive(archive, directory)
+
+	# Gather the FIT files of all week directories in the todos directory. Only the files that
+	# aren't in the manifest yet (i.e. the ones downloaded by this run, or all of them the first
+	# time) are touched; the manifest is thrown away if the todos directory has been removed.
+	def aggregate_fit_files(self):
+		activity_index = self.activity_index
+		todos_directory = self.options.directory + '/todos'
+		if not isdir(todos_directory):
+			activity_index.forget_aggregated()
+			ensure_directory(todos_directory)
+		new_files = sorted(filename for filename in self.existing_files - activity_index.aggregated_files()
+			if filename.lower().endswith('.fit'))
+		methods = dict()
+		for filename in new_files:
+			self.progress(filename)
+			name = os.path.basename(filename)
+			temp_filename = todos_directory + '/.' + name + '.part'
+			if isfile(temp_filename):
+				remove(temp_filename)
+			method = link_or_copy(filename, temp_filename)
+			os.rename(temp_filename, todos_directory + '/' + name)
+			activity_index.record_aggregated(filename, name)
+			methods[method] = methods.get(method, 0) + 1
+		activity_index.commit()
+		if new_files:
+			print str(len(new_files)) + ' FIT files added to ' + todos_directory + ' (' + \
+				', '.join(str(count) + ' ' + method for method, count in sorted(methods.items())) + ')'
+
+	# Set up the pools, the index and the response cache, scan the export tree and open the sinks.
+	def open(self):
+		options = self.options
+		if not options.dry_run:
+			ensure_directory(options.directory)
+
+		if self.shared_worker_pool:
+			self.worker_pool = self.shared_worker_pool
+			self.map_activities = self.worker_pool.imap
+		elif options.workers > 1:
+			self.worker_pool = ThreadPool(options.workers)
+			self.map_activities = self.worker_pool.imap
+		else:
+			self.worker_pool = None
+			self.map_activities = imap
+
+		# Original archives are unzipped on a pool of their own, one thread per CPU (zlib releases
+		# the GIL while inflating), while the downloads carry on.
+		if 'original' in options.format and options.unzip and not options.dry_run:
+			self.unzip_pool = ThreadPool(multiprocessing.cpu_count())
+		else:
+			self.unzip_pool = None
+		# The records processed but not handed over yet, in listing order, with their pending extractions.
+		self.unfinished = deque()
+		# The records processed by the workers that imap hasn't handed back yet, by activity id.
+		self.completed = dict()
+		self.completed_lock = threading.Lock()
+
+		index_filename = options.directory + '/activities_index.sqlite'
+		self.activity_index = ActivityIndex(':memory:' if options.dry_run and not isfile(index_filename) else index_filename)
+
+		if options.no_cache:
+			self.response_cache = None
+		else:
+			cache_filename = options.directory + '/http_cache.sqlite'
+			self.response_cache = ResponseCache(':memory:' if options.dry_run and not isfile(cache_filename) else cache_filename,
+				options.cache_ttl * 24 * 3600, options.cache_size * 1024 * 1024)
+
+		# Files from before the index (or this version of it) were exported completely; newer
+		# files that aren't in it were left behind by a run that failed (see plan_activity).
+		self.index_created = self.activity_index.get_meta('created_at')
+		if self.index_created is None:
+			self.index_created = time.time()
+			self.activity_index.set_meta('created_at', self.index_created)
+
+		self.existing_directories, self.existing_files, self.extracted_files = self.scan_export_directory()
+		self.pages_listed = 0
+		self.activities_listed = 0
+		self.activities_existing = 0
+		self.activities_planned = 0
+		self.downloads_planned = 0
+		self.directories_existing = len(self.existing_directories)
+
+		self.pager = ActivityPager(self.connection, self.total_to_download,
+			self.activity_index.get_meta('page_size', limit_maximum), self.progress, self.search_filters())
+
+		# A dry run doesn't write anything.
+		self.open_sinks = []
+		if not options.dry_run:
+			for sink in self.sinks:
+				sink.open(self)
+				self.open_sinks.append(sink)
+
+	# The parameters of the listing for --after, --before and --type, so that Garmin only lists
+	# the activities to export. Garmin's endDate is inclusive. It takes a single activity type.
+	def search_filters(self):
+		options = self.options
+		filters = dict()
+		if options.after:
+			filters['startDate'] = options.after.isoformat()
+		if options.before:
+			filters['endDate'] = (options.before - timedelta(days=1)).isoformat()
+		if options.type and len(options.type) == 1:
+			filters['activityType'] = options.type[0]
+		return filters
+
+	# Whether a listed activity was started before --before and is of a --type. The listing
+	# may not have been filtered (the filters are ignored by older endpoints), so it's checked
+	# here again; --after is checked by iter_activities.
+	def selected(self, a):
+		options = self.options
+		if options.before and a['startTimeLocal'][:10] >= options.before.isoformat():
+			return False
+		if options.type:
+			activity_type = dict() if absentOrNull('activityType', a) else a['activityType']
+			if activity_type.get('typeKey') not in options.type and parent_type_id.get(activity_type.get('parentTypeId')) not in options.type:
+				return False
+		return True
 
-csv_file.close()
+	# Hand over the records at the head of the unfinished queue whose files are all on disk (with
+	# wait, all of them): index them, write the new ones to the sinks and yield them, in listing order.
+	def finished_records(self, wait=False):
+		while self.unfinished:
+			record, extraction = self.unfinished[0]
+			if extraction:
+				if not (wait or extraction.ready() or len(self.unfinished) > self.max_unfinished):
+					break
+				record['formats']['original'] = extraction.get()
+				record['files'] = record_files(record)
+			self.unfinished.popleft()
+			self.hand_over(record)
+			yield record
+
+	# Index the files of a record and write it to the sinks.
+	def hand_over(self, record):
+		with self.metrics.phase('write'):
+			for format, filenames in record['formats'].iteritems():
+				self.activity_index.record(record['activity'], format, filenames)
+			self.existing_files.update(record['files'])
+			# Activities that are only being exported again for more formats already have a row.
+			if record['new']:
+				for sink in self.open_sinks:
+					sink.write(record)
+			self.metrics.count('activities_exported')
+
+	# When the export is cut short, hand over the records of the activities that have been
+	# processed all the same (their data files are on disk, so the next run would take them
+	# for exported): the ones held back for an archive and the ones imap hasn't handed back.
+	def salvage(self):
+		with self.completed_lock:
+			left = list(self.unfinished) + sorted(self.completed.values(),
+				key=lambda processed: processed[0]['activity']['startTimeGMT'], reverse=True)
+			self.unfinished.clear()
+			self.completed.clear()
+		for record, extraction in left:
+			if extraction:
+				try:
+					record['formats']['original'] = extraction.get()
+				except Exception:
+					continue
+				record['files'] = record_files(record)
+			self.hand_over(record)
+
+	# Export the activities, yielding the record of each one as soon as it has been exported
+	# (newest first). The activities that have been exported before are skipped. A dry run
+	# yields nothing but prints what would be downloaded.
+	def iter_activities(self):
+		options = self.options
+		self.open()
+		try:
+			# This for loop will download data from the server in multiple chunks, if necessary.
+			for result, activities in self.pager.pages():
+				self.pages_listed += 1
+
+				# Persist JSON
+				if not options.dry_run:
+					# Compressed pages are appended as separate gzip members (or zstd frames), which
+					# readers decompress one after the other.
+					json_filename = options.directory + '/activities.json' + self.compressed_suffix
+					json_file = open(json_filename, 'ab' if options.compress else 'a')
+					for chunk in self.compress([result]):
+						json_file.write(chunk)
+					json_file.close()
+
+				# Activities are listed newest first, so everything after the first indexed one has been exported before.
+				reached_indexed = False
+				if options.incremental:
+					for i, a in enumerate(activities):
+						if all(self.activity_index.has_format(a['activityId'], format) for format in options.format):
+							print 'Activity ' + str(a['activityId']) + ' has been exported before; stopping after this page.'
+							activities = activities[:i]
+							reached_indexed = True
+							break
+
+				# Activities are listed newest first, too, so the listing can stop at the first one older than --after.
+				reached_after = False
+				if options.after or options.before or options.type:
+					selected = []
+					for a in activities:
+						if options.after and a['startTimeLocal'][:10] < options.after.isoformat():
+							print 'Activity ' + str(a['activityId']) + ' started before ' + options.after.isoformat() + '; stopping after this page.'
+							reached_after = True
+							break
+						if self.selected(a):
+							selected.append(a)
+					activities = selected
+
+				plans = self.plan_page(activities)
+				existing_plans = [plan for plan in plans if not (plan['downloads'] or plan['unrecorded'])]
+				work_plans = [plan for plan in plans if plan['downloads'] or plan['unrecorded']]
+				self.activities_listed += len(plans)
+				self.activities_existing += len(existing_plans)
+				self.activities_planned += len(work_plans)
+				self.downloads_planned += sum(len(plan['downloads']) for plan in work_plans)
+
+				if options.dry_run:
+					if reached_indexed or reached_after:
+						break
+					continue
+
+				for plan in existing_plans:
+					self.progress('Garmin Connect activity: [' + str(plan['activity']['activityId']) + '] data file already exists; skipping...')
+					# Files found on disk rather than in the index (exported before it existed) are indexed once.
+					for format, filenames in plan['existing'].iteritems():
+						if not self.activity_index.has_format(plan['activity']['activityId'], format):
+							self.activity_index.record(plan['activity'], format, filenames)
+
+				# Process each activity. imap hands the results back in listing order, so the
+				# records are written to the sinks in the same order regardless of the number of workers.
+				for processed in self.map_activities(self.process_planned, work_plans):
+					with self.completed_lock:
+						self.completed.pop(processed[0]['activity']['activityId'], None)
+					self.unfinished.append(processed)
+					for record in self.finished_records():
+						yield record
+				with self.metrics.phase('write'):
+					self.activity_index.set_meta('page_size', self.pager.page_size)
+					self.activity_index.commit()
+				self.metrics.count('activities_skipped', len(existing_plans))
+
+				if reached_indexed or reached_after:
+					break
+			# End for loop for multiple chunks.
+
+			if options.dry_run:
+				self.print_dry_run()
+				return
+
+			if self.unzip_pool:
+				print 'Waiting for ' + str(len([record for record, extraction in self.unfinished if extraction])) + ' archives to be unzipped...'
+			for record in self.finished_records(wait=True):
+				yield record
+			self.finish()
+		finally:
+			self.close()
+
+	def print_dry_run(self):
+		# The listing pages were the only requests; each activity to download needs a detail
+		# request and a download per missing format, plus a device request unless the device
+		# has been seen before.
+		activities_planned = self.activities_planned
+		downloads_planned = self.downloads_planned
+		print 'Dry run: ' + str(self.activities_listed) + ' activities listed in ' + str(self.pages_listed) + ' pages'
+		print '\t' + str(self.activities_existing) + ' already exported'
+		print '\t' + str(activities_planned) + ' to download (format: ' + ', '.join(self.options.format) + ')'
+		print '\t' + str(len(self.existing_directories) - self.directories_existing) + ' week directories to create'
+		print '\tEstimated requests: ' + str(activities_planned + downloads_planned) + ' to ' + str(2 * activities_planned + downloads_planned) + \
+			' (' + str(activities_planned) + ' details, up to ' + str(activities_planned) + ' devices, ' + str(downloads_planned) + ' downloads)'
+
+	# Wrap up a complete export: the todos directory, the tracks and, once the sinks are done
+	# with the records of this run, the metrics computed from the data files.
+	def finish(self):
+		self.activity_index.commit()
+
+		with self.metrics.phase('todos'):
+			self.aggregate_fit_files()
+
+		if self.options.tracks is not None:
+			print 'Extracting tracks...'
+			with self.metrics.phase('tracks'):
+				tracks_extracted = gctracks.extract_tracks(self.options.directory, self.options.tracks or None)
+			print str(tracks_extracted) + ' tracks extracted.'
+			self.metrics.count('tracks_extracted', tracks_extracted)
+
+		if self.options.enrich is not None:
+			self.close_sinks()
+			print 'Computing metrics from the data files...'
+			with self.metrics.phase('enrich'):
+				metrics = gctracks.activity_metrics(self.options.directory, self.options.enrich or None)
+			for sink in self.sinks:
+				sink.backfill(metrics)
+
+	# Stop the pools (which are idle unless the export was cut short; the activities being
+	# processed are finished first), hand over what has been processed, close the sinks and
+	# the databases. What has been indexed so far is kept.
+	def close(self):
+		if self.worker_pool:
+			self.worker_pool.terminate()
+			self.worker_pool.join()
+		self.salvage()
+		if self.unzip_pool:
+			self.unzip_pool.terminate()
+			self.unzip_pool.join()
+		self.close_sinks()
+		self.activity_index.commit()
+		self.activity_index.close()
+		if self.response_cache:
+			self.response_cache.close()
+
+	def close_sinks(self):
+		for sink in self.open_sinks:
+			sink.close()
+		self.open_sinks = []
+
+	# Export everything, for when the records themselves aren't needed.
+	def run(self):
+		for record in self.iter_activities():
+			pass
+
+# The session cookies are kept between runs, so that the next run can skip the login
+# while the session is still valid.
+def session_filename(options):
+	return options.session_file or options.directory + '/.session_cookies'
+
+# Log in with the saved session if it's still valid (unless force is set), or else with the
+# username and password in the options (prompting for the ones that are missing).
+def log_in(connection, options, force=False):
+	login_started = time.time()
+	if not (force or options.force_login) and connection.load(session_filename(options)) and connection.valid():
+		print 'Reusing the saved session.'
+	else:
+		connection.cookie_jar.clear()
+		username = options.username if options.username else raw_input('Username: ')
+		password = options.password if options.password else getpass()
+		connection.login(username, password)
+	connection.metrics.add_time('login', time.time() - login_started)
+
+	# We should be logged in now. A dry run doesn't write anything.
+	if not options.dry_run:
+		if not isdir(options.directory):
+			os.makedirs(options.directory)
+		connection.save(session_filename(options))
+
+def default_sinks(options):
+	sinks = [CsvSink()]
+	if options.summary_format:
+		sinks.append(SummarySink(options.summary_format))
+	return sinks
+
+# The accounts of an --accounts file: a list of (name, options), with the options of args
+# for everything but the username, password, directory and session file of each account.
+def read_accounts(filename, args):
+	config = ConfigParser.RawConfigParser()
+	if not config.read(filename):
+		raise Exception('Could not read the accounts in ' + filename)
+
+	def get(name, option, default=None):
+		return config.get(name, option) if config.has_option(name, option) else default
+
+	accounts = []
+	for name in config.sections():
+		options = copy.copy(args)
+		options.username = get(name, 'username')
+		options.password = get(name, 'password')
+		options.directory = get(name, 'directory', os.path.join(args.directory, name) + '/')
+		options.session_file = get(name, 'session_file')
+		accounts.append((name, options))
+	return accounts
+
+# Export several accounts in one process. Their connections share session and scheduler
+# (so --rate is the request budget of the whole batch), and their activities are processed
+# on a FairPool of --workers workers; each account has its own cookie jar, session file,
+# export directory and device cache. The logins happen one after the other (they may prompt
+# for a password), then the accounts are exported side by side. Returns the names of the
+# accounts that failed.
+def export_accounts(accounts, args, session, scheduler, metrics):
+	failed = []
+	logged_in = []
+	for name, options in accounts:
+		print 'Account ' + name + ':'
+		connection = GarminConnect(args.server, metrics=metrics, session=session, scheduler=scheduler)
+		try:
+			log_in(connection, options)
+		except Exception as e:
+			print 'Account ' + name + ': could not log in (' + str(e) + ')'
+			failed.append(name)
+			continue
+		logged_in.append((name, options, connection))
+
+	pool = FairPool(args.workers)
 
-for filename in glob.iglob(args.directory + '/**Semana**/*.fit'):
-	print(filename)
-	shutil.copy2(filename, args.directory + '/todos/')
+	def export(name, options, connection):
+		try:
+			Exporter(connection, options, default_sinks(options), pool.queue()).run()
+			if not options.dry_run:
+				connection.save(session_filename(options))
+			print 'Account ' + name + ': done.'
+		except Exception as e:
+			print 'Account ' + name + ': failed (' + str(e) + ')'
+			failed.append(name)
+
+	threads = [threading.Thread(target=export, args=account) for account in logged_in]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		while thread.is_alive():
+			thread.join(1)  # With a timeout, so that Ctrl-C still gets through.
+	pool.close()
+	return failed
+
+# Number of activities at the head of the listing that --watch checks for new ones.
+watch_head_size = 5
+
+# The activities at the head of the listing (as selected by the options), and whether
+# any of them is new, i.e. missing from the index in one of the formats; None if the session
+# has expired (Garmin answers with an error or the sign-in page then).
+def poll_head(connection, options):
+	exporter = Exporter(connection, options)
+	search_params = dict(exporter.search_filters(), start=0, limit=watch_head_size)
+	try:
+		with connection.metrics.phase('listing'):
+			head = json.loads(connection.http_req(connection.url_gc_search + urlencode(search_params), expected_codes=(401, 403)))
+	except urllib2.HTTPError as e:
+		if e.code not in (401, 403):
+			raise
+		return None
+	except ValueError:
+		return None
+
+	activity_index = ActivityIndex(options.directory + '/activities_index.sqlite')
+	try:
+		new = [i for i, a in enumerate(head)
+			if (not options.after or a['startTimeLocal'][:10] >= options.after.isoformat()) and exporter.selected(a) and
+				not all(activity_index.has_format(a['activityId'], format) for format in options.format)]
+	finally:
+		activity_index.close()
+	return head, new
+
+# Keep exporting the new activities of the account every options.watch seconds (--watch).
+# Each check is a single listing request for the head of the listing, on the connection
+# (and login session) of the first export; the session is only renewed once Garmin rejects
+# it. When there are new activities, the listing is exported down to the last new one, or
+# incrementally if all of the head is new.
+def watch(connection, options, metrics, session, scheduler):
+	while True:
+		time.sleep(options.watch)
+		try:
+			polled = poll_head(connection, options)
+			if polled is None:
+				print 'The session has expired; logging in again.'
+				metrics.count('session_renewals')
+				log_in(connection, options, force=True)
+				polled = poll_head(connection, options)
+				if polled is None:
+					raise Exception('the new session was rejected')
+			head, new = polled
+			metrics.count('watch_polls')
+			if new:
+				print time.strftime('%Y-%m-%d %H:%M:%S') + ': ' + str(len(new)) + ' new activities.'
+				export_options = copy.copy(options)
+				if new[-1] == len(head) - 1:
+					export_options.count = 'all'
+					export_options.incremental = True
+				else:
+					export_options.count = str(new[-1] + 1)
+				Exporter(connection, export_options, default_sinks(export_options)).run()
+				connection.save(session_filename(options))
+		except Exception as e:
+			print time.strftime('%Y-%m-%d %H:%M:%S') + ': check for new activities failed (' + str(e) + ')'
+			metrics.count('watch_errors')
+		if options.metrics_file:
+			save_metrics(metrics, session, scheduler, options.metrics_file)
+
+# Save the metrics of the run so far, with the connection counts of the session and scheduler.
+def save_metrics(metrics, session, scheduler, filename):
+	metrics.set('connections_opened', session.connections_opened)
+	metrics.set('connections_reused', session.connections_reused)
+	metrics.set('requests_retried', scheduler.retried)
+	metrics.save(filename)
+
+def main():
+	args = parse_options()
+
+	if args.version:
+		print argv[0] + ", version " + script_version
+		exit(0)
+
+	print 'Welcome to Garmin Connect Exporter!'
+
+	accounts = read_accounts(args.accounts, args) if args.accounts else None
+
+	# Create directory for data files.
+	if not accounts and isdir(args.directory):
+		print 'Warning: Output directory already exists. Will skip already-downloaded files and append to the CSV file.'
+
+	if args.watch and not (args.username and args.password):
+		# --watch logs in again whenever the session expires, so it can't prompt then.
+		if not sys.stdin.isatty():
+			parser.error('--watch needs --username and --password when it is not run from a terminal')
+		args.username = args.username or raw_input('Username: ')
+		args.password = args.password or getpass()
+
+	metrics = Metrics()
+	session = HTTPSession(args.timeout)
+	# Leave a slot per account for the listing, which is fetched while the workers download the previous page.
+	scheduler = RequestScheduler(args.rate, args.workers + (len(accounts) if accounts else 1), args.retries)
+
+	if accounts:
+		failed = export_accounts(accounts, args, session, scheduler, metrics)
+	else:
+		failed = []
+		connection = GarminConnect(args.server, metrics=metrics, session=session, scheduler=scheduler)
+		log_in(connection, args)
+		Exporter(connection, args, default_sinks(args)).run()
+		# Garmin may have refreshed some cookies during the run.
+		if not args.dry_run:
+			connection.save(session_filename(args))
+
+	if args.dry_run:
+		exit(1 if failed else 0)
+
+	print 'HTTP connections: ' + str(session.connections_opened) + ' opened, ' + str(session.connections_reused) + ' reused, ' + \
+		str(scheduler.retried) + ' requests retried'
+
+	if args.metrics_file:
+		save_metrics(metrics, session, scheduler, args.metrics_file)
+
+	if failed:
+		print 'Failed: ' + ', '.join(failed)
+		exit(1)
+
+	if args.watch:
+		print 'Checking for new activities every ' + str(args.watch) + ' seconds (Ctrl-C to stop)...'
+		try:
+			watch(connection, args, metrics, session, scheduler)
+		except KeyboardInterrupt:
+			pass
+	print 'Done!'
 
-print 'Done!'
+if __name__ == '__main__':
+	main()
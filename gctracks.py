@@ -0,0 +1,555 @@
+#!/usr/bin/python
+
+"""
+File: gctracks.py
+
+Description:	Extract the track points of the activity files exported by gcexport.py
+				(GPX, TCX, FIT or the original ZIP archives) into compact binary track
+				files, so that the time series can be analyzed without parsing XML again.
+
+				A track file (tracks/<activityId>.track in the export directory) is a
+				16-byte header (the magic 'GCTRACK1', then the number of points and the
+				number of columns as little-endian uint32) followed by the columns one
+				after another, each as little-endian float64 values; missing values are
+				NaN. The columns are listed in track_columns. With numpy, load_track()
+				memory-maps a track file.
+
+				activity_metrics() computes the metrics of each activity that Garmin's JSON
+				lacks (e.g. the minimum heart rate) from its track points, for
+				'gcexport.py --enrich'.
+
+				open_exported() opens an exported file whether it was saved as is or
+				compressed with 'gcexport.py --compress' (activity_<id>.gpx.gz...).
+"""
+
+from array import array
+from multiprocessing import Pool
+from os.path import isdir, isfile, getmtime
+from xml.etree.cElementTree import iterparse
+
+import argparse
+import calendar
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import struct
+import sys
+import zipfile
+
+from io import BytesIO
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+track_magic = 'GCTRACK1'
+track_header = struct.Struct('<8sII')
+
+# timestamp is in seconds since the epoch, latitude and longitude in degrees, elevation in
+# meters, heart rate in bpm, cadence in rpm, power in watts and temperature in degrees C.
+track_columns = ['timestamp', 'latitude', 'longitude', 'elevation', 'heart_rate', 'cadence', 'power', 'temperature']
+
+nan = float('nan')
+
+# Column arrays of the points of one track, filled in by the parsers below.
+class Track(object):
+	def __init__(self):
+		self.columns = [array('d') for name in track_columns]
+
+	def __len__(self):
+		return len(self.columns[0])
+
+	def append(self, point):
+		for column, name in zip(self.columns, track_columns):
+			value = point.get(name)
+			column.append(nan if value is None else value)
+
+def local_name(tag):
+	return tag.rsplit('}', 1)[-1]
+
+def float_or_none(text):
+	try:
+		return float(text)
+	except (TypeError, ValueError):
+		return None
+
+iso_time = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+
+# Seconds since the epoch of an ISO 8601 time as used in GPX and TCX files (UTC unless
+# there's an offset).
+def parse_time(text):
+	match = iso_time.match(text.strip()) if text else None
+	if not match:
+		return None
+	seconds = calendar.timegm(tuple(int(match.group(i)) for i in range(1, 7)))
+	if match.group(7):
+		seconds += float(match.group(7))
+	zone = match.group(8)
+	if zone and zone != 'Z':
+		offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+		seconds -= offset if zone[0] == '+' else -offset
+	return seconds
+
+# The element names (without namespace) of the values of GPX trkpt and TCX Trackpoint
+# elements, including those of the Garmin TrackPointExtension and ActivityExtension.
+gpx_fields = {'ele': 'elevation', 'hr': 'heart_rate', 'cad': 'cadence',
+	'power': 'power', 'PowerInWatts': 'power', 'atemp': 'temperature'}
+tcx_fields = {'LatitudeDegrees': 'latitude', 'LongitudeDegrees': 'longitude',
+	'AltitudeMeters': 'elevation', 'Cadence': 'cadence', 'RunCadence': 'cadence', 'Watts': 'power'}
+
+# Stream the elements of an XML file (a file name or file object) with iterparse, yielding
+# each start and end event with the element and its ancestors. Each element is dropped once
+# its end event has been handled, so that memory use doesn't grow with the file size.
+def stream_elements(source):
+	parents = []
+	for event, element in iterparse(source, events=('start', 'end')):
+		if event == 'start':
+			yield event, element, parents
+			parents.append(element)
+			continue
+		parents.pop()
+		yield event, element, parents
+		element.clear()
+		if parents:
+			del parents[-1][-1]  # The element just parsed is always its parent's last child.
+
+# Parse a GPX or TCX file (a file name or file object) into a Track.
+def parse_xml(source):
+	track = Track()
+	point = None
+	for event, element, parents in stream_elements(source):
+		name = local_name(element.tag)
+		if event == 'start':
+			if name in ('trkpt', 'Trackpoint'):
+				point = dict()
+				if name == 'trkpt':
+					point['latitude'] = float_or_none(element.get('lat'))
+					point['longitude'] = float_or_none(element.get('lon'))
+		elif point is not None:
+			if name in ('trkpt', 'Trackpoint'):
+				track.append(point)
+				point = None
+			elif name == 'Value' and parents and local_name(parents[-1].tag) == 'HeartRateBpm':
+				point['heart_rate'] = float_or_none(element.text)
+			elif name == 'time' or name == 'Time':
+				point['timestamp'] = parse_time(element.text)
+			else:
+				field = gpx_fields.get(name) or tcx_fields.get(name)
+				if field:
+					point[field] = float_or_none(element.text)
+	return track
+
+# Count the track points of an exported GPX file (compressed or not; an empty file has
+# none). With stop_at_first, stops at the first track point found.
+def count_track_points(filename, stop_at_first=False):
+	if not os.path.getsize(filename):
+		return 0
+	count = 0
+	with open_exported(filename) as gpx_file:
+		for event, element, parents in stream_elements(gpx_file):
+			if event == 'start' and local_name(element.tag) == 'trkpt':
+				count += 1
+				if stop_at_first:
+					break
+	return count
+
+# FIT base types: struct format and invalid value, by base type number (the low 5 bits of
+# the base type byte). Strings and the 64-bit types aren't needed for track points.
+fit_base_types = {
+	0: ('B', 0xFF), 1: ('b', 0x7F), 2: ('B', 0xFF), 3: ('h', 0x7FFF), 4: ('H', 0xFFFF),
+	5: ('i', 0x7FFFFFFF), 6: ('I', 0xFFFFFFFF), 8: ('f', None), 9: ('d', None),
+	10: ('B', 0x00), 11: ('H', 0x0000), 12: ('I', 0x00000000), 13: ('B', 0xFF) }
+
+# Fields of the FIT 'record' message (global message number 20) and their conversion.
+semicircles = 180.0 / 2 ** 31
+fit_record_fields = {
+	253: ('timestamp', lambda value: value + 631065600),  # FIT time starts on 1989-12-31 UTC.
+	0: ('latitude', lambda value: value * semicircles),
+	1: ('longitude', lambda value: value * semicircles),
+	2: ('elevation', lambda value: value / 5.0 - 500),
+	78: ('elevation', lambda value: value / 5.0 - 500),  # enhanced_altitude
+	3: ('heart_rate', float),
+	4: ('cadence', float),
+	7: ('power', float),
+	13: ('temperature', float) }
+
+# A minimal FIT decoder: reads the 'record' messages of a FIT file (data as a string),
+# including compressed timestamp headers, and skips everything else.
+def parse_fit(data):
+	track = Track()
+	if len(data) < 12 or data[8:12] != '.FIT':
+		return track
+	header_size = ord(data[0])
+	end = header_size + struct.unpack('<I', data[4:8])[0]
+	position = header_size
+	definitions = dict()
+	timestamp = None
+	while position < end:
+		record_header = ord(data[position])
+		position += 1
+		if record_header & 0x80:
+			# Compressed timestamp header: a data message with a 5-bit time offset.
+			local_type = (record_header >> 5) & 0x03
+			offset = record_header & 0x1F
+			if timestamp is not None:
+				timestamp = (timestamp & ~0x1F) + offset + (0x20 if offset < (timestamp & 0x1F) else 0)
+			compressed_timestamp = timestamp
+		elif record_header & 0x40:
+			# Definition message.
+			local_type = record_header & 0x0F
+			endian = '>' if ord(data[position + 1]) else '<'
+			global_number = struct.unpack(endian + 'H', data[position + 2:position + 4])[0]
+			field_count = ord(data[position + 4])
+			position += 5
+			fields = []
+			for i in range(field_count):
+				fields.append((ord(data[position]), ord(data[position + 1]), ord(data[position + 2])))
+				position += 3
+			developer_size = 0
+			if record_header & 0x20:
+				developer_count = ord(data[position])
+				position += 1
+				for i in range(developer_count):
+					developer_size += ord(data[position + 1])
+					position += 3
+			definitions[local_type] = (endian, global_number, fields, developer_size)
+			continue
+		else:
+			local_type = record_header & 0x0F
+			compressed_timestamp = None
+
+		endian, global_number, fields, developer_size = definitions[local_type]
+		point = dict()
+		for number, size, base_type in fields:
+			format, invalid = fit_base_types.get(base_type & 0x1F, (None, None))
+			if format and struct.calcsize('<' + format) == size:
+				value = struct.unpack(endian + format, data[position:position + size])[0]
+				if value != invalid and value == value:
+					if number == 253:
+						timestamp = value
+					if global_number == 20 and number in fit_record_fields:
+						name, convert = fit_record_fields[number]
+						point[name] = convert(value)
+			position += size
+		position += developer_size
+
+		if global_number == 20:
+			if 'timestamp' not in point and compressed_timestamp is not None:
+				point['timestamp'] = compressed_timestamp + 631065600
+			track.append(point)
+	return track
+
+# The extensions of the files compressed by gcexport.py --compress, and their compression.
+compressed_extensions = {'gz': 'gzip', 'zst': 'zstd'}
+
+# A zstd stream reader that also closes the file it reads from.
+class ZstdFile(object):
+	def __init__(self, filename):
+		self.raw = open(filename, 'rb')
+		self.reader = zstandard.ZstdDecompressor().stream_reader(self.raw, read_across_frames=True)
+
+	def read(self, size=-1):
+		return self.reader.read(size)
+
+	def close(self):
+		self.reader.close()
+		self.raw.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+# Open an exported file for reading, decompressing it if its name ends in .gz or .zst.
+# Empty files (written when Garmin had no data) stay empty whatever their name.
+def open_exported(filename):
+	compression = compressed_extensions.get(filename.rsplit('.', 1)[-1].lower())
+	if not compression:
+		return open(filename, 'rb')
+	if not os.path.getsize(filename):
+		return BytesIO()
+	if compression == 'gzip':
+		return gzip.open(filename, 'rb')
+	if not zstandard:
+		raise ValueError('Reading ' + filename + ' needs the zstandard module')
+	return ZstdFile(filename)
+
+# The extension of an exported file, without the compression extension.
+def file_extension(filename):
+	parts = filename.lower().rsplit('.', 2)
+	if len(parts) == 3 and parts[2] in compressed_extensions:
+		return parts[1]
+	return parts[-1]
+
+# Parse an exported activity file by its extension. ZIP archives (format 'original') are
+# parsed from their first FIT, TCX or GPX member without extracting it.
+def parse_file(filename):
+	extension = file_extension(filename)
+	if extension == 'fit':
+		with open(filename, 'rb') as fit_file:
+			return parse_fit(fit_file.read())
+	if extension in ('gpx', 'tcx'):
+		if not os.path.getsize(filename):
+			return Track()
+		with open_exported(filename) as xml_file:
+			return parse_xml(xml_file)
+	if extension == 'zip':
+		if not os.path.getsize(filename):
+			return Track()
+		with zipfile.ZipFile(filename) as archive:
+			for name in archive.namelist():
+				member_extension = name.rsplit('.', 1)[-1].lower()
+				if member_extension == 'fit':
+					return parse_fit(archive.read(name))
+				if member_extension in ('gpx', 'tcx'):
+					return parse_xml(archive.open(name))
+		return Track()
+	raise ValueError('Unrecognized activity file: ' + filename)
+
+def write_track(filename, track):
+	temp_filename = filename + '.part'
+	with open(temp_filename, 'wb') as track_file:
+		track_file.write(track_header.pack(track_magic, len(track), len(track.columns)))
+		for column in track.columns:
+			if sys.byteorder != 'little':
+				column = array('d', column)
+				column.byteswap()
+			column.tofile(track_file)
+	os.rename(temp_filename, filename)
+
+# Read a track file into a dict of column name to array('d').
+def read_track(filename):
+	with open(filename, 'rb') as track_file:
+		magic, points, column_count = track_header.unpack(track_file.read(track_header.size))
+		if magic != track_magic:
+			raise ValueError('Not a track file: ' + filename)
+		columns = dict()
+		for name in track_columns[:column_count]:
+			column = array('d')
+			column.fromfile(track_file, points)
+			if sys.byteorder != 'little':
+				column.byteswap()
+			columns[name] = column
+	return columns
+
+# Memory-map a track file as a dict of column name to numpy array (needs numpy).
+def load_track(filename):
+	with open(filename, 'rb') as track_file:
+		magic, points, column_count = track_header.unpack(track_file.read(track_header.size))
+	if magic != track_magic:
+		raise ValueError('Not a track file: ' + filename)
+	data = numpy.memmap(filename, dtype='<f8', mode='r', offset=track_header.size, shape=(column_count, points))
+	return dict(zip(track_columns, data))
+
+# Exported activity files, best source first: FIT has the most data, GPX the least.
+source_patterns = [
+	('fit', re.compile(r'^(\d+)(_[A-Z]+)?\.fit$', re.IGNORECASE)),
+	('zip', re.compile(r'^activity_(\d+)\.zip$')),
+	('tcx', re.compile(r'^activity_(\d+)\.tcx(\.gz|\.zst)?$')),
+	('gpx', re.compile(r'^activity_(\d+)\.gpx(\.gz|\.zst)?$')) ]
+
+# The week directories of an export. gcexport.py appends 'YYYY-SemanaNN' to the export
+# directory name as given, so they're inside it only if it was given with a trailing slash.
+def week_directories(directory):
+	pattern = '[0-9][0-9][0-9][0-9]-Semana*'
+	found = glob.glob(directory + pattern) + glob.glob(os.path.join(directory, pattern))
+	return sorted(set(os.path.normpath(path) for path in found if isdir(path)))
+
+# Find the activity files in the week directories of an export, returning a dict of
+# activity id to the best file for it. Empty files (written when Garmin had no data in
+# that format) only count if there's nothing else.
+def find_sources(directory):
+	sources = dict()
+	for week_directory in week_directories(directory):
+		for name in os.listdir(week_directory):
+			for rank, (format, pattern) in enumerate(source_patterns):
+				match = pattern.match(name)
+				if match:
+					activity_id = int(match.group(1))
+					filename = week_directory + '/' + name
+					if not os.path.getsize(filename):
+						rank += len(source_patterns)
+					if activity_id not in sources or rank < sources[activity_id][0]:
+						sources[activity_id] = (rank, filename)
+					break
+	return dict((activity_id, filename) for activity_id, (rank, filename) in sources.iteritems())
+
+def extract_track(job):
+	activity_id, source, target = job
+	try:
+		track = parse_file(source)
+		write_track(target, track)
+		return activity_id, len(track), None
+	except Exception as e:
+		return activity_id, 0, '%s: %s' % (source, e)
+
+# Extract the tracks of all activity files in an export directory that don't have an
+# up-to-date track file yet, on a pool of processes (one per CPU unless processes is given).
+# Returns the number of tracks extracted.
+def extract_tracks(directory, processes=None, activity_ids=None):
+	tracks_directory = directory + '/tracks'
+	if not isdir(tracks_directory):
+		os.mkdir(tracks_directory)
+
+	jobs = []
+	for activity_id, source in sorted(find_sources(directory).iteritems()):
+		if activity_ids is not None and activity_id not in activity_ids:
+			continue
+		target = tracks_directory + '/' + str(activity_id) + '.track'
+		if isfile(target) and getmtime(target) >= getmtime(source):
+			continue
+		jobs.append((activity_id, source, target))
+	if not jobs:
+		return 0
+
+	pool = Pool(processes)
+	try:
+		extracted = 0
+		for activity_id, points, error in pool.imap_unordered(extract_track, jobs):
+			if error:
+				print 'Could not extract the track of activity ' + str(activity_id) + ': ' + error
+			else:
+				extracted += 1
+	finally:
+		pool.close()
+		pool.join()
+	return extracted
+
+# The minimum, maximum and mean of the values of a column that aren't NaN, and the sums of
+# its rises and falls from one value to the next (adding 0.0 turns the -0.0 of a column that
+# never falls into 0.0); None if there are no values.
+def column_statistics(column):
+	if numpy:
+		values = column if isinstance(column, numpy.ndarray) else numpy.frombuffer(column, dtype=numpy.float64)
+		values = values[~numpy.isnan(values)]
+		if not len(values):
+			return None
+		steps = numpy.diff(values)
+		return float(values.min()), float(values.max()), float(values.mean()), \
+			float(steps[steps > 0].sum()), -float(steps[steps < 0].sum()) + 0.0
+	values = [value for value in column if value == value]
+	if not values:
+		return None
+	steps = [b - a for a, b in zip(values, values[1:])]
+	return min(values), max(values), sum(values) / len(values), \
+		sum(step for step in steps if step > 0), -sum(step for step in steps if step < 0) + 0.0
+
+# Metrics of a track (a dict of column name to array, as returned by read_track or
+# load_track) for the summary of the activity, named as in gcexport.summary_row: the number
+# of points, the heart rate and temperature ranges and averages, and the range, gain and
+# loss of the elevation as recorded (not corrected by Garmin). Metrics without samples are
+# None. Vectorized with numpy if it's available.
+def track_metrics(columns):
+	metrics = {'sample_count': len(columns['timestamp'])}
+	for column, minimum, maximum, average in (
+			('heart_rate', 'min_hr', 'max_hr', 'average_hr'),
+			('temperature', 'min_temperature', 'max_temperature', 'average_temperature'),
+			('elevation', 'min_elevation', 'max_elevation', None)):
+		statistics = column_statistics(columns[column])
+		metrics[minimum], metrics[maximum] = statistics[:2] if statistics else (None, None)
+		if average:
+			metrics[average] = statistics[2] if statistics else None
+		else:
+			metrics['elevation_gain'], metrics['elevation_loss'] = statistics[3:] if statistics else (None, None)
+	return metrics
+
+# The metrics of activity files by the SHA-1 of their contents, kept in an SQLite database
+# in the export directory, so that each file is only parsed once. The hashes are kept by
+# path, size and modification time, so that unchanged files aren't read again either.
+class MetricsCache(object):
+	def __init__(self, filename):
+		self.connection = sqlite3.connect(filename)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+			'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS metrics (digest TEXT PRIMARY KEY, metrics TEXT)')
+		self.connection.commit()
+
+	def digest(self, filename):
+		size, mtime = os.path.getsize(filename), getmtime(filename)
+		row = self.connection.execute('SELECT size, mtime, digest FROM files WHERE path = ?', (filename,)).fetchone()
+		if row and row[0] == size and row[1] == mtime:
+			return row[2]
+		sha1 = hashlib.sha1()
+		with open(filename, 'rb') as source_file:
+			for chunk in iter(lambda: source_file.read(1024 * 1024), ''):
+				sha1.update(chunk)
+		digest = sha1.hexdigest()
+		self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (filename, size, mtime, digest))
+		return digest
+
+	def get(self, digest):
+		row = self.connection.execute('SELECT metrics FROM metrics WHERE digest = ?', (digest,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def put(self, digest, metrics):
+		self.connection.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?)', (digest, json.dumps(metrics)))
+
+	def close(self):
+		self.connection.commit()
+		self.connection.close()
+
+# Read the track of an activity file from its track file if that's up to date, parsing
+# the activity file otherwise.
+def compute_metrics(job):
+	activity_id, digest, source, track_filename = job
+	try:
+		if isfile(track_filename) and getmtime(track_filename) >= getmtime(source):
+			columns = load_track(track_filename) if numpy else read_track(track_filename)
+		else:
+			columns = dict(zip(track_columns, parse_file(source).columns))
+		return activity_id, digest, track_metrics(columns), None
+	except Exception as e:
+		return activity_id, digest, None, '%s: %s' % (source, e)
+
+# The metrics (see track_metrics) of the activities with a non-empty activity file in an
+# export directory, as a dict of activity id to metrics. The files that aren't in the cache
+# (track_metrics.sqlite in the export directory) are parsed on a pool of processes (one per
+# CPU unless processes is given).
+def activity_metrics(directory, processes=None):
+	cache = MetricsCache(directory + '/track_metrics.sqlite')
+	try:
+		metrics = dict()
+		jobs = []
+		for activity_id, source in sorted(find_sources(directory).iteritems()):
+			if not os.path.getsize(source):
+				continue
+			digest = cache.digest(source)
+			cached = cache.get(digest)
+			if cached is not None:
+				metrics[activity_id] = cached
+			else:
+				jobs.append((activity_id, digest, source, directory + '/tracks/' + str(activity_id) + '.track'))
+
+		if jobs:
+			pool = Pool(processes)
+			try:
+				for activity_id, digest, computed, error in pool.imap_unordered(compute_metrics, jobs, 4):
+					if error:
+						print 'Could not compute the metrics of activity ' + str(activity_id) + ': ' + error
+					else:
+						cache.put(digest, computed)
+						metrics[activity_id] = computed
+			finally:
+				pool.close()
+				pool.join()
+	finally:
+		cache.close()
+	return metrics
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Extract the tracks of the activity files in a gcexport.py export directory.')
+	parser.add_argument('directory', help="the export directory")
+	parser.add_argument('-p', '--processes', type=int, help="number of processes (default: one per CPU)")
+	args = parser.parse_args()
+	print str(extract_tracks(args.directory, args.processes)) + ' tracks extracted.'